@@ -0,0 +1,150 @@
+# Benchmarks for the collection and the /data endpoints.
+#
+# Runs the app against the local mock GitHub API (mockgithub.py) and a
+# database filled by gendata.py. Reports the collection throughput and,
+# per endpoint, the p50/p99 latency and peak memory. Results can be written
+# to a JSON file and compared against an earlier run to spot regressions:
+#
+#   python bench.py --db "db2://..." --output baseline.json
+#   python bench.py --db "db2://..." --baseline baseline.json --tolerance 0.2
+#
+# Exits with status 1 if a result is worse than the baseline by more than
+# the tolerance.
+
+import argparse, json, os, statistics, sys, time, tracemalloc
+
+from mockgithub import startMockGitHub
+from gendata import BENCH_EMAIL
+
+backendDir=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+endpoints=[
+    "/data/repostats.txt",
+    "/data/repostats.txt?draw=1&start=0&length=25&order[0][column]=3&order[0][dir]=desc",
+    "/data/repostats.txt?draw=1&start=0&length=25&order[0][column]=3&order[0][dir]=desc&search[value]=repo10",
+    "/data/repostatsWorkWeek.txt",
+    "/data/repostatsMonth.txt",
+    "/data/repostats.csv",
+    "/data/repositories.txt",
+    "/data/export?format=csv&compress=gzip&from=2000-01-01",
+    "/data/repostats.json",
+    "/data/repostats.json?granularity=week&from=2000-01-01",
+]
+
+def percentile(values, p):
+    values=sorted(values)
+    return values[min(len(values)-1, int(round(p/100.0*(len(values)-1))))]
+
+# Import the app configured for the benchmark environment
+def loadApp(args, mockURL):
+    os.environ.update({'DB2_URI': args.db, 'APPID_CLIENT_ID': 'bench', 'APPID_SECRET': 'bench',
+                       'APPID_OAUTH_SERVER_URL': 'https://appid.invalid', 'FULL_HOSTNAME': 'http://127.0.0.1',
+                       'GITHUB_API_URL': mockURL, 'COLLECT_WORKERS': str(args.workers)})
+    if args.no_cache:
+        os.environ['DATA_CACHE_BYTES']='0'
+    os.chdir(backendDir)
+    sys.path.insert(0, backendDir)
+    import ghstats
+    return ghstats
+
+def benchCollection(ghstats, mock):
+    requestsBefore=mock.requests
+    tracemalloc.start()
+    started=time.perf_counter()
+    with ghstats.app.app_context():
+        progress={}
+        ghstats.collectStatistics(logPrefix='bench', progress=progress)
+    elapsed=time.perf_counter()-started
+    peak=tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'repos': progress['reposDone'], 'errors': progress['errors'],
+            'githubRequests': mock.requests-requestsBefore,
+            'seconds': round(elapsed, 3),
+            'reposPerSecond': round(progress['reposDone']/elapsed, 2) if elapsed>0 else 0,
+            'peakMemoryKB': peak//1024}
+
+def benchEndpoints(ghstats, iterations):
+    client=ghstats.app.test_client()
+    with client.session_transaction() as session:
+        # what a logged in user looks like to flask-pyoidc and the app
+        session.update({'current_provider': 'default', 'last_authenticated': int(time.time()),
+                        'last_session_refresh': int(time.time()),
+                        'id_token': {'email': BENCH_EMAIL, 'name': 'bench'},
+                        'access_token': 'bench', 'userrole': 7})
+    results={}
+    for url in endpoints:
+        latencies=[]
+        size=0
+        tracemalloc.start()
+        for i in range(iterations):
+            started=time.perf_counter()
+            response=client.get(url, headers={'Accept-Encoding': 'gzip'})
+            body=response.get_data()
+            latencies.append((time.perf_counter()-started)*1000)
+            if response.status_code!=200:
+                raise RuntimeError("%s returned %d" % (url, response.status_code))
+            size=len(body)
+        peak=tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[url]={'p50ms': round(percentile(latencies, 50), 2),
+                      'p99ms': round(percentile(latencies, 99), 2),
+                      'meanms': round(statistics.mean(latencies), 2),
+                      'bytes': size, 'peakMemoryKB': peak//1024}
+        print("%-100s p50 %8.2fms  p99 %8.2fms  %8d bytes" % (url, results[url]['p50ms'], results[url]['p99ms'], size))
+    return results
+
+# List results worse than the baseline by more than the tolerance
+def regressions(report, baseline, tolerance):
+    found=[]
+    if 'collection' in report and 'collection' in baseline:
+        now, before=report['collection']['reposPerSecond'], baseline['collection']['reposPerSecond']
+        if now<before*(1-tolerance):
+            found.append("collection: %.2f repos/s, baseline %.2f" % (now, before))
+    for url, result in report.get('endpoints', {}).items():
+        before=baseline.get('endpoints', {}).get(url)
+        if before is None:
+            continue
+        for metric in ('p50ms', 'p99ms', 'peakMemoryKB'):
+            if result[metric]>before[metric]*(1+tolerance):
+                found.append("%s: %s %s, baseline %s" % (url, metric, result[metric], before[metric]))
+    return found
+
+
+if __name__ == "__main__":
+    parser=argparse.ArgumentParser(description="Benchmark collection and data endpoints")
+    parser.add_argument('--db', default=os.getenv("DB2_URI"), help="database URI, DB2_URI by default")
+    parser.add_argument('--latency', type=float, default=50, help="mock GitHub latency in milliseconds")
+    parser.add_argument('--rate-limit', type=int, default=5000, help="mock GitHub requests per token and hour")
+    parser.add_argument('--workers', type=int, default=8, help="COLLECT_WORKERS for the collection")
+    parser.add_argument('--iterations', type=int, default=50, help="requests per endpoint")
+    parser.add_argument('--no-cache', action='store_true', help="disable the response cache")
+    parser.add_argument('--skip-collection', action='store_true')
+    parser.add_argument('--skip-endpoints', action='store_true')
+    parser.add_argument('--output', help="write the results as JSON to that file")
+    parser.add_argument('--baseline', help="compare against results of an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown against the baseline")
+    args=parser.parse_args()
+    if not args.db:
+        sys.exit("No database given, use --db or set DB2_URI")
+
+    # the app runs from the backend directory
+    args.output=os.path.abspath(args.output) if args.output else None
+    args.baseline=os.path.abspath(args.baseline) if args.baseline else None
+
+    mock=startMockGitHub(latency=args.latency/1000.0, rateLimit=args.rate_limit)
+    ghstats=loadApp(args, "http://127.0.0.1:%d" % mock.server_address[1])
+    report={'settings': vars(args)}
+    if not args.skip_collection:
+        report['collection']=benchCollection(ghstats, mock)
+        print("collection: %(repos)d repos in %(seconds).2fs, %(reposPerSecond).2f repos/s, %(githubRequests)d GitHub requests" % report['collection'])
+    if not args.skip_endpoints:
+        report['endpoints']=benchEndpoints(ghstats, args.iterations)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found=regressions(report, json.load(f), args.tolerance)
+        for line in found:
+            print("REGRESSION "+line)
+        sys.exit(1 if found else 0)
@@ -0,0 +1,126 @@
+# Local stand-in for the GitHub traffic API, used by the benchmarks.
+#
+# Serves /repos/{org}/{repo}/traffic/views and /repos/{org}/{repo}/traffic/clones
+# with synthetic data for the past 14 days. Responses can be delayed and
+# each token is subject to a rate limit, reported with the same headers
+# GitHub uses. Like GitHub, responses carry an ETag and conditional requests
+# get a 304 that does not count against the rate limit. Point the app to it
+# by setting GITHUB_API_URL.
+#
+# Usage: python mockgithub.py [--port 8765] [--latency 50] [--rate-limit 5000]
+
+import argparse, base64, datetime, hashlib, json, random, re, threading, time, zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+trafficPath=re.compile(r'^/repos/([^/]+)/([^/]+)/traffic/(views|clones)$')
+
+# Synthetic traffic for the past 14 days. The numbers are derived from the
+# repository name, so that repeated calls return consistent data.
+def trafficData(org, repo, traffic_type, today=None):
+    today=today or datetime.date.today()
+    rnd=random.Random(zlib.crc32((org+'/'+repo+'/'+traffic_type).encode('utf-8')))
+    scale=rnd.choice([0, 1, 5, 20, 100, 1000])
+    days=[]
+    for offset in range(14, 0, -1):
+        day=today-datetime.timedelta(days=offset)
+        count=int(rnd.random()*scale)
+        if count==0 and scale<5:
+            # GitHub leaves out days without traffic
+            continue
+        days.append({'timestamp': day.isoformat()+'T00:00:00Z', 'count': count,
+                     'uniques': max(1, count//3)})
+    return {'count': sum(d['count'] for d in days),
+            'uniques': sum(d['uniques'] for d in days),
+            traffic_type: days}
+
+
+class MockGitHub(ThreadingHTTPServer):
+    daemon_threads=True
+
+    def __init__(self, address, latency=0.0, rateLimit=5000, window=3600):
+        super().__init__(address, MockGitHubHandler)
+        self.latency=latency
+        self.rateLimit=rateLimit
+        self.window=window
+        self.budgets={}
+        self.lock=threading.Lock()
+        self.requests=0
+
+    # Book a request for the token, returns (allowed, remaining, reset)
+    def book(self, token, cost=1):
+        with self.lock:
+            self.requests=self.requests+1
+            now=time.time()
+            remaining, reset=self.budgets.get(token, (self.rateLimit, int(now)+self.window))
+            if reset<=now:
+                remaining, reset=self.rateLimit, int(now)+self.window
+            if remaining<cost or remaining<=0:
+                return False, 0, reset
+            self.budgets[token]=(remaining-cost, reset)
+            return True, remaining-cost, reset
+
+
+class MockGitHubHandler(BaseHTTPRequestHandler):
+    protocol_version='HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        token='anonymous'
+        auth=self.headers.get('Authorization', '')
+        if auth.startswith('Basic '):
+            token=base64.b64decode(auth[6:]).decode('utf-8').split(':', 1)[-1]
+        if self.server.latency>0:
+            time.sleep(self.server.latency)
+        match=trafficPath.match(self.path.split('?')[0])
+        body=None
+        etag=None
+        if match is not None:
+            body=trafficData(*match.groups())
+            etag='"'+hashlib.sha1(json.dumps(body).encode('utf-8')).hexdigest()+'"'
+        notModified=etag is not None and self.headers.get('If-None-Match')==etag
+        allowed, remaining, reset=self.server.book(token, cost=0 if notModified else 1)
+        headers={'X-RateLimit-Limit': str(self.server.rateLimit),
+                 'X-RateLimit-Remaining': str(remaining),
+                 'X-RateLimit-Reset': str(reset)}
+        if not allowed:
+            self.reply(403, {'message': 'API rate limit exceeded'}, headers)
+        elif match is None:
+            self.reply(404, {'message': 'Not Found'}, headers)
+        elif notModified:
+            headers['ETag']=etag
+            self.reply(304, None, headers)
+        else:
+            headers['ETag']=etag
+            self.reply(200, body, headers)
+
+    def reply(self, status, body, headers):
+        data=json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+# Start the mock server in a background thread, returns the server
+def startMockGitHub(port=0, latency=0.0, rateLimit=5000, window=3600):
+    server=MockGitHub(('127.0.0.1', port), latency=latency, rateLimit=rateLimit, window=window)
+    threading.Thread(target=server.serve_forever, name='mockgithub', daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser=argparse.ArgumentParser(description="Mock GitHub traffic API")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0, help="response delay in milliseconds")
+    parser.add_argument('--rate-limit', type=int, default=5000, help="requests per token and window")
+    parser.add_argument('--window', type=int, default=3600, help="rate limit window in seconds")
+    args=parser.parse_args()
+    server=MockGitHub(('127.0.0.1', args.port), latency=args.latency/1000.0,
+                      rateLimit=args.rate_limit, window=args.window)
+    print("Mock GitHub API on http://127.0.0.1:%d" % args.port)
+    server.serve_forever()
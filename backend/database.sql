@@ -17,10 +17,16 @@ create table repos
   rname varchar(255) not null,
   ghserverid int not null,
   oid int not null,  --- this is the org or user
-  schedule int not null
+  schedule int not null,  --- collection tier: 0 hot (every run), 1 warm, 2 cold
+  lastcollected timestamp,  --- start of the run that last collected the traffic
+  deleted timestamp  --- set when deleted, the data is purged in the background
 ) organize by row;
 
 --- Github traffic statistics for views and clones
+--- Range partitioned by quarter, so that queries on recent data skip
+--- the old partitions. Old days are removed by the retention settings
+--- of the app (RETAIN_DAILY_DAYS), an administrator could also detach
+--- old partitions instead.
 create table repotraffic
 (
   rid int not null,
@@ -29,12 +35,68 @@ create table repotraffic
   vuniques int not null default 0,
   clonecount int not null default 0,
   cuniques int not null default 0
-) organize by row;
+) organize by row
+  partition by range(tdate)
+  (starting minvalue ending '2017-12-31',
+   starting '2018-01-01' ending '2039-12-31' every 3 months,
+   starting '2040-01-01' ending maxvalue);
 
 --- indexes to improve tdate-based search
 create index repotraffic_ix_rid_tdate on repotraffic(rid,tdate);
 create index repotraffic_ix_tdate on repotraffic(tdate);
 
+--- last traffic window fetched per repository with its digest, so that
+--- only new or increased days are merged, and the ETags of the responses
+create table repowindow
+(
+  rid int unique not null,
+  digest char(40) not null,
+  days varchar(4000) not null, --- JSON object, day: [views, uniques, clones, uniques]
+  viewetag varchar(255),    --- ETags of the GitHub responses for conditional requests
+  cloneetag varchar(255)
+) organize by row;
+
+--- traffic statistics of deleted repositories, kept if archiving is enabled
+create table repotrafficarchive
+(
+  rid int not null,
+  orgname varchar(255) not null,
+  reponame varchar(255) not null,
+  tdate date not null,
+  viewcount int not null default 0,
+  vuniques int not null default 0,
+  clonecount int not null default 0,
+  cuniques int not null default 0,
+  archived timestamp not null default current timestamp
+) organize by row;
+
+--- Weekly and monthly rollups of the traffic statistics, maintained
+--- by the collection for the days it merged. Weeks start on Monday
+--- (ISO weeks), months on the first day of the month.
+create table repotrafficweekly
+(
+  rid int not null,
+  weekstart date not null,
+  viewcount int not null default 0,
+  vuniques int not null default 0,
+  clonecount int not null default 0,
+  cuniques int not null default 0
+) organize by row;
+
+create unique index repotrafficweekly_ix_rid_weekstart on repotrafficweekly(rid,weekstart);
+
+create table repotrafficmonthly
+(
+  rid int not null,
+  monthstart date not null,
+  viewcount int not null default 0,
+  vuniques int not null default 0,
+  clonecount int not null default 0,
+  cuniques int not null default 0
+) organize by row;
+
+create unique index repotrafficmonthly_ix_rid_monthstart on repotrafficmonthly(rid,monthstart);
+
 --- The tenant, i.e. the user which accesses Github.
 --- Hence the ghuser (Github user) name and access token
 create table tenants
@@ -76,6 +138,57 @@ create table systemlog
   state varchar(255)
 ) organize by row;
 
+--- version of the traffic and repository data, incremented with each
+--- change, used by all app instances to validate their cached responses
+create table dataversion
+(
+  version int not null,
+  modified timestamp not null  --- UTC
+) organize by row;
+
+insert into dataversion values(1, current timestamp - current timezone);
+
+--- collection runs, an interrupted run is resumed instead of starting over
+create table collectruns
+(
+  runid int unique not null generated by default as identity (start with 1, increment by 1),
+  started timestamp not null,
+  updated timestamp not null,
+  state varchar(20) not null --- running, completed or abandoned
+) organize by row;
+
+--- work queue of a collection run, one entry per tenant and repository.
+--- App instances lease batches of entries, so that several of them can
+--- collect in parallel. Expired leases are taken over by others.
+create table collectwork
+(
+  runid int not null,
+  tid int not null,
+  rid int not null,
+  state varchar(10) not null, --- pending, leased, done, failed or skipped
+  owner varchar(100),         --- instance holding the lease
+  leaseuntil timestamp,
+  attempts int not null default 0
+) organize by row;
+
+create unique index collectwork_ix_runid_tid_rid on collectwork(runid,tid,rid);
+create index collectwork_ix_runid_state on collectwork(runid,state);
+
+--- repositories failing to be collected, e.g., renamed or without access.
+--- They are skipped for a growing number of runs and quarantined if they
+--- keep failing with errors that will not go away by themselves.
+create table repofailures
+(
+  rid int unique not null,    --- repository of the collection work entry
+  status int,                 --- last HTTP status, NULL for other errors
+  message varchar(255),
+  failures int not null,      --- consecutive failures
+  skipruns int not null,      --- runs to skip before the next try
+  firstfailed timestamp not null,
+  lastfailed timestamp not null,
+  quarantined char(1) not null default 'N'  --- Y: not collected until released
+) organize by row;
+
 --- system administration users, those working with the Python app
 create table adminusers
 (
@@ -101,6 +214,16 @@ create table admintenantreporoles
   rid int
 ) organize by row;
 
+--- repositories a system user has access to, maintained by the app
+--- from v_adminuserrepos to avoid evaluating the view for every query
+create table useraccess
+(
+  email varchar(255) not null,
+  rid int not null
+) organize by row;
+
+create unique index useraccess_ix_email_rid on useraccess(email,rid);
+
 --- What roles are available? System metadata, not really needed
 create table adminrolevalues
 (
@@ -139,4 +262,7 @@ create or replace view v_repostats as (
 create view v_adminrepolist as
 (
   select r.rid, gu.username as orgname, r.rname as reponame, v.email from ghorgusers gu, repos r, v_adminuserrepos v where r.oid=gu.oid and v.rid=r.rid
-)
+);
+
+--- initialize the access index from the role information
+insert into useraccess (email, rid) select distinct email, rid from v_adminuserrepos
@@ -11,9 +11,16 @@
 # Written by Henrik Loeser (data-henrik), hloeser@de.ibm.com
 # (C) 2018-2022 by IBM
 
-import flask, os, datetime, decimal, re, requests, time
-import json
+import flask, os, datetime, decimal, re, requests, time, threading, socket
+import json, uuid, csv, io, zlib, hashlib, itertools
 from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+# change detection, rollups, retention and downsampling of the traffic data
+from ghtraffic import diffTraffic, updateRollups, retentionCutoffs, lttb
 
 # for loading .env
 from dotenv import load_dotenv
@@ -28,9 +35,24 @@ from flask import (Flask, jsonify, make_response, redirect,request,
 from flask_pyoidc.flask_pyoidc import OIDCAuthentication
 from flask_pyoidc.provider_configuration import ProviderConfiguration, ClientMetadata, ProviderMetadata
 
+# Faster JSON encoding if available
+try:
+    import orjson
+except ImportError:
+    orjson=None
+
+# Parquet and Arrow exports if available
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow=None
+
 # Database access using SQLAlchemy
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.pool import NullPool
+from sqlalchemy import event
 
 # Advanced security
 from flask_talisman import Talisman, ALLOW_FROM
@@ -124,6 +146,116 @@ APPID_SECRET=os.getenv("APPID_SECRET", APPID_SECRET)
 # Event settings
 EVENT_TOKEN=os.getenv("EVENT_TOKEN","CE_rulez")
 
+# Data API settings
+# Size in bytes of the chunks streamed by the /data endpoints, and whether
+# to gzip-compress the streams for clients accepting it.
+STREAM_CHUNK_SIZE=int(os.getenv("STREAM_CHUNK_SIZE", "65536"))
+STREAM_GZIP=os.getenv("STREAM_GZIP", "true").lower() in ("true", "1", "yes")
+# Rows per batch (Parquet row group, Arrow record batch) of the export
+EXPORT_BATCH_ROWS=int(os.getenv("EXPORT_BATCH_ROWS", "50000"))
+
+# Response cache for the /data endpoints
+# Total and per-response size limits in bytes (0 disables the cache) and
+# how often (in seconds) to read the data version, which is changed by all
+# instances, from the database.
+DATA_CACHE_BYTES=int(os.getenv("DATA_CACHE_BYTES", str(64*1024*1024)))
+DATA_CACHE_MAX_ENTRY=int(os.getenv("DATA_CACHE_MAX_ENTRY", str(8*1024*1024)))
+DATA_VERSION_CHECK=int(os.getenv("DATA_VERSION_CHECK", "10"))
+
+# How long (in seconds) user roles are cached in the app and for how many users
+ACCESS_CACHE_TTL=int(os.getenv("ACCESS_CACHE_TTL", "300"))
+ACCESS_CACHE_SIZE=int(os.getenv("ACCESS_CACHE_SIZE", "1000"))
+
+# Maximum number of points per repository returned for the chart
+CHART_MAX_POINTS=int(os.getenv("CHART_MAX_POINTS", "200"))
+
+# Bearer token required to read /metrics, the endpoint is disabled if not set
+METRICS_TOKEN=os.getenv("METRICS_TOKEN")
+
+# Collection settings
+# Number of worker threads fetching traffic data from GitHub in parallel.
+# With 1 (the default) repositories are processed one after another.
+COLLECT_WORKERS=int(os.getenv("COLLECT_WORKERS", "1"))
+# Number of traffic rows written with a single batched MERGE
+MERGE_BATCH_SIZE=int(os.getenv("MERGE_BATCH_SIZE", "500"))
+# Number of repositories leased (and committed) at a time
+COLLECT_COMMIT_EVERY=int(os.getenv("COLLECT_COMMIT_EVERY", "50"))
+# An interrupted run is resumed if it made progress within that many hours
+COLLECT_RESUME_HOURS=int(os.getenv("COLLECT_RESUME_HOURS", "12"))
+# Lease time in seconds for repositories being collected. Leases are renewed
+# every third of that time while working on them, even while waiting for
+# GitHub. Those of crashed instances expire and are taken over.
+COLLECT_LEASE_SECONDS=int(os.getenv("COLLECT_LEASE_SECONDS", "300"))
+# Number of times a repository is leased within a run. Once the lease
+# expired that often, e.g. because the repository keeps crashing the
+# instances, it is marked failed instead of being taken over again.
+COLLECT_MAX_ATTEMPTS=int(os.getenv("COLLECT_MAX_ATTEMPTS", "3"))
+# Repositories failing with a 4xx status are skipped for 1, 2, 4, ... runs,
+# up to COLLECT_BACKOFF_MAX_RUNS, but never for longer than COLLECT_MAX_HOURS
+# so that GitHub still has their traffic. Other errors, e.g. 5xx responses
+# or connection problems, are tried again with the next run. After
+# COLLECT_QUARANTINE_AFTER failures in a row with a status of 403, 404, 410
+# or 451 they are quarantined until released on the system log page.
+COLLECT_BACKOFF_MAX_RUNS=int(os.getenv("COLLECT_BACKOFF_MAX_RUNS", "16"))
+COLLECT_QUARANTINE_AFTER=int(os.getenv("COLLECT_QUARANTINE_AFTER", "5"))
+
+# Adaptive scheduling
+# Repositories are put into tiers by their views and clones in the past
+# COLLECT_ACTIVITY_DAYS days: hot ones (at least COLLECT_HOT_ACTIVITY) are
+# collected every run, others by the first run at least COLLECT_WARM_HOURS
+# after their last collection and those without any traffic after
+# COLLECT_COLD_HOURS. 0 collects them every run. GitHub only keeps 14 days,
+# so no repository waits longer than COLLECT_MAX_HOURS. New repositories
+# start as hot.
+COLLECT_ACTIVITY_DAYS=int(os.getenv("COLLECT_ACTIVITY_DAYS", "14"))
+COLLECT_HOT_ACTIVITY=int(os.getenv("COLLECT_HOT_ACTIVITY", "50"))
+COLLECT_WARM_HOURS=int(os.getenv("COLLECT_WARM_HOURS", "24"))
+COLLECT_COLD_HOURS=int(os.getenv("COLLECT_COLD_HOURS", "168"))
+COLLECT_MAX_HOURS=240
+# How often (in seconds) to look for a running collection to join, so that
+# all app instances take part. 0 (the default) only collects when triggered.
+COLLECT_POLL_INTERVAL=int(os.getenv("COLLECT_POLL_INTERVAL", "0"))
+# Number of finished collection jobs kept to report their errors
+COLLECT_JOBS_KEPT=int(os.getenv("COLLECT_JOBS_KEPT", "10"))
+
+# Repository deletion
+# Deleted repositories are hidden right away, their traffic data is purged
+# in the background in chunks of PURGE_BATCH_SIZE rows, pausing PURGE_PAUSE
+# seconds between the chunks. With PURGE_ARCHIVE the rows are copied to the
+# table repotrafficarchive before they are deleted.
+PURGE_BATCH_SIZE=int(os.getenv("PURGE_BATCH_SIZE", "5000"))
+PURGE_PAUSE=float(os.getenv("PURGE_PAUSE", "0.5"))
+PURGE_ARCHIVE=os.getenv("PURGE_ARCHIVE", "false").lower() in ("true", "1", "yes")
+
+# Retention of the traffic data
+# After a collection run, daily traffic older than RETAIN_DAILY_DAYS days and
+# weekly rollups older than RETAIN_WEEKLY_DAYS days are removed, in chunks
+# of PURGE_BATCH_SIZE rows. The monthly rollups keep the full history.
+# 0 (the default) keeps everything. Daily data is kept for at least
+# RETAIN_DAILY_MIN days, so that the rollups still being collected for
+# stay complete, and back to a month starting on a Monday, which can be up
+# to 14 months earlier.
+RETAIN_DAILY_DAYS=int(os.getenv("RETAIN_DAILY_DAYS", "0"))
+RETAIN_WEEKLY_DAYS=int(os.getenv("RETAIN_WEEKLY_DAYS", "0"))
+RETAIN_DAILY_MIN=60
+
+# GitHub API client settings
+# The pool size is the number of keep-alive connections per tenant token,
+# timeouts are in seconds.
+GITHUB_API_URL=os.getenv("GITHUB_API_URL", "https://api.github.com")
+GITHUB_POOL_SIZE=int(os.getenv("GITHUB_POOL_SIZE", "10"))
+GITHUB_CONNECT_TIMEOUT=float(os.getenv("GITHUB_CONNECT_TIMEOUT", "5"))
+GITHUB_READ_TIMEOUT=float(os.getenv("GITHUB_READ_TIMEOUT", "30"))
+
+# GitHub rate limit handling
+# Requests kept in reserve per token, budget below which requests are spread
+# evenly until the reset, longest wait (in seconds) for a reset or back-off
+# before giving up, and retries after hitting a (secondary) rate limit.
+GITHUB_RATELIMIT_RESERVE=int(os.getenv("GITHUB_RATELIMIT_RESERVE", "10"))
+GITHUB_RATELIMIT_PACE_BELOW=int(os.getenv("GITHUB_RATELIMIT_PACE_BELOW", "100"))
+GITHUB_RATELIMIT_MAX_WAIT=int(os.getenv("GITHUB_RATELIMIT_MAX_WAIT", "900"))
+GITHUB_MAX_RETRIES=int(os.getenv("GITHUB_MAX_RETRIES", "3"))
+
 # Full hostname
 # Code Engine started to inject new environment variables. CE_SUBDOMAIN
 # is only set for new apps after that change. Old apps continue to set
@@ -155,6 +287,18 @@ if (DB2_URI and APPID_CLIENT_ID and APPID_OAUTH_SERVER_URL and APPID_SECRET and
     app.config['SQLALCHEMY_DATABASE_URI']=DB2_URI
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS']=False
     app.config['SQLALCHEMY_ECHO']=False
+    # Connection pool for the (remote, SSL) Db2 connections. Pre-ping and
+    # recycling avoid handing out connections dropped while idle.
+    # DB_NULLPOOL=true opens a new connection for each use instead.
+    if os.getenv("DB_NULLPOOL", "false").lower() in ("true", "1", "yes"):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS']={'poolclass': NullPool}
+    else:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS']={
+            'pool_size': int(os.getenv("DB_POOL_SIZE", "5")),
+            'max_overflow': int(os.getenv("DB_MAX_OVERFLOW", "10")),
+            'pool_timeout': int(os.getenv("DB_POOL_TIMEOUT", "30")),
+            'pool_recycle': int(os.getenv("DB_POOL_RECYCLE", "1800")),
+            'pool_pre_ping': os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1", "yes")}
 
     # Configure access to App ID service for the OpenID Connect client
     appID_clientinfo=ClientMetadata(client_id=APPID_CLIENT_ID,client_secret=APPID_SECRET)
@@ -166,6 +310,16 @@ if (DB2_URI and APPID_CLIENT_ID and APPID_OAUTH_SERVER_URL and APPID_SECRET and
     # Initialize SQLAlchemy for our database
     db = SQLAlchemy(app, session_options={'autocommit': True})
 
+    # Count pool events for the usage statistics
+    dbPoolEvents={'connect': 0, 'checkout': 0, 'checkin': 0, 'invalidate': 0}
+    def countPoolEvent(name):
+        def listener(*args):
+            dbPoolEvents[name]=dbPoolEvents[name]+1
+        return listener
+    with app.app_context():
+        for name in dbPoolEvents:
+            event.listen(db.engine, name, countPoolEvent(name))
+
 
     # Three (3) decorators that wrap the auth decorators. See the comments
     # in the ELSE for the background
@@ -224,6 +378,102 @@ else:
 
 
 
+# Metrics
+# Counters, gauges and histograms kept in the app process and exposed in the
+# Prometheus text format on /metrics.
+metricsLock=threading.Lock()
+metricDefs=OrderedDict()
+metricValues={}
+latencyBuckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+rowBuckets=(1, 10, 100, 1000, 10000, 100000, 1000000)
+
+def defineMetric(name, mtype, helptext, buckets=None):
+    metricDefs[name]=(mtype, helptext, buckets)
+    metricValues[name]={}
+
+defineMetric('ghstats_github_request_seconds', 'histogram', 'GitHub API request latency by HTTP status', latencyBuckets)
+defineMetric('ghstats_github_not_modified_total', 'counter', 'Conditional GitHub requests answered with 304 Not Modified')
+defineMetric('ghstats_merge_seconds', 'histogram', 'Duration of merging a batch of traffic rows', latencyBuckets)
+defineMetric('ghstats_merge_rows_total', 'counter', 'Traffic rows merged into repotraffic')
+defineMetric('ghstats_merge_rows_unchanged_total', 'counter', 'Fetched traffic rows skipped as unchanged')
+defineMetric('ghstats_collection_seconds', 'histogram', 'Duration of completed collection runs', latencyBuckets)
+defineMetric('ghstats_collection_last_success_timestamp', 'gauge', 'Time of the last completed collection run')
+defineMetric('ghstats_collection_repos_total', 'counter', 'Repositories handled by collection runs by result')
+defineMetric('ghstats_data_query_seconds', 'histogram', 'Latency of the /data queries until the last row', latencyBuckets)
+defineMetric('ghstats_data_query_rows', 'histogram', 'Rows returned by the /data queries', rowBuckets)
+defineMetric('ghstats_db_pool_connections', 'gauge', 'Database pool connections by state')
+defineMetric('ghstats_purge_rows_total', 'counter', 'Traffic rows purged for deleted repositories')
+defineMetric('ghstats_purge_repos_total', 'counter', 'Deleted repositories purged completely')
+defineMetric('ghstats_retention_rows_total', 'counter', 'Rows removed by the retention by table')
+
+def metricKey(labels):
+    return tuple(sorted(labels.items()))
+
+def incMetric(name, value=1, **labels):
+    with metricsLock:
+        key=metricKey(labels)
+        metricValues[name][key]=metricValues[name].get(key, 0)+value
+
+def setMetric(name, value, **labels):
+    with metricsLock:
+        metricValues[name][metricKey(labels)]=value
+
+def observeMetric(name, value, **labels):
+    buckets=metricDefs[name][2]
+    with metricsLock:
+        key=metricKey(labels)
+        entry=metricValues[name].get(key)
+        if entry is None:
+            entry=[[0]*len(buckets), 0.0, 0]
+            metricValues[name][key]=entry
+        for i, bound in enumerate(buckets):
+            if value<=bound:
+                entry[0][i]=entry[0][i]+1
+        entry[1]=entry[1]+value
+        entry[2]=entry[2]+1
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{'+','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                        for k, v in labels)+'}'
+
+# All metrics in the Prometheus text exposition format
+def renderMetrics():
+    lines=[]
+    with metricsLock:
+        for name, (mtype, helptext, buckets) in metricDefs.items():
+            lines.append('# HELP %s %s' % (name, helptext))
+            lines.append('# TYPE %s %s' % (name, mtype))
+            for labels, value in metricValues[name].items():
+                if mtype=='histogram':
+                    counts, total, count=value
+                    for bound, n in zip(buckets, counts):
+                        lines.append('%s_bucket%s %d' % (name, formatLabels(labels+(('le', repr(float(bound))),)), n))
+                    lines.append('%s_bucket%s %d' % (name, formatLabels(labels+(('le', '+Inf'),)), count))
+                    lines.append('%s_sum%s %r' % (name, formatLabels(labels), total))
+                    lines.append('%s_count%s %d' % (name, formatLabels(labels), count))
+                else:
+                    lines.append('%s%s %r' % (name, formatLabels(labels), value))
+    return '\n'.join(lines)+'\n'
+
+# Run a query for a /data endpoint. The rows are passed through a generator
+# which records the latency until the last row and the number of rows.
+def dataQuery(stmt, *params, query='rows'):
+    endpoint=request.endpoint
+    started=time.perf_counter()
+    result=db.engine.execute(stmt, *params)
+    def rows():
+        count=0
+        try:
+            for row in result:
+                count=count+1
+                yield row
+        finally:
+            observeMetric('ghstats_data_query_seconds', time.perf_counter()-started, endpoint=endpoint, query=query)
+            observeMetric('ghstats_data_query_rows', count, endpoint=endpoint, query=query)
+    return rows()
+
 # Encoder to handle some raw data correctly
 def alchemyencoder(obj):
     """JSON encoder function for SQLAlchemy special classes."""
@@ -231,9 +481,233 @@ def alchemyencoder(obj):
         return obj.isoformat()
     elif isinstance(obj, decimal.Decimal):
         return float(obj)
+    raise TypeError("Type %s not serializable" % type(obj))
+
+# Encode an object as JSON (bytes), dates and decimals are handled
+def encodeJSON(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, default=alchemyencoder)
+    return json.dumps(obj, default=alchemyencoder, separators=(',', ':')).encode('utf-8')
+
+# Serialize result rows as JSON arrays, wrapped into the DataTables
+# '{"data": [...]}' object. Output is collected into larger chunks.
+def jsonRowChunks(rows, prefix=b'{ "data": [\n', suffix=b']}'):
+    buf=bytearray(prefix)
+    first=True
+    for row in rows:
+        if not first:
+            buf+=b',\n'
+        else:
+            first=False
+        buf+=encodeJSON(list(row))
+        if len(buf)>=STREAM_CHUNK_SIZE:
+            yield bytes(buf)
+            buf.clear()
+    buf+=suffix
+    yield bytes(buf)
+
+# Serialize result rows as CSV lines after the header, in larger chunks
+def csvRowChunks(rows, header):
+    buf=io.StringIO()
+    writer=csv.writer(buf, lineterminator='\n')
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buf.tell()>=STREAM_CHUNK_SIZE:
+            yield buf.getvalue().encode('utf-8')
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode('utf-8')
+
+# gzip-compress a stream of chunks
+def gzipChunks(chunks):
+    compressor=zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+    for chunk in chunks:
+        data=compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+# Streaming response for the /data endpoints, compressed if the client
+# accepts gzip
+def streamResponse(chunks, mimetype):
+    headers={'Vary': 'Accept-Encoding'}
+    if STREAM_GZIP and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        chunks=gzipChunks(chunks)
+        headers['Content-Encoding']='gzip'
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+
+
+# Data version and response cache
+# Traffic data only changes with a collection run (or when repositories are
+# added or removed). Each change increments the data version kept in the
+# table dataversion, so that all instances (and restarted ones) agree on it.
+# Responses are cached per user and data version and evicted least recently
+# used once the cache exceeds DATA_CACHE_BYTES.
+dataVersion={'version': None, 'modified': time.time(), 'checked': 0}
+dataCache=OrderedDict()
+dataCacheSize=0
+dataCacheLock=threading.Lock()
+
+dataVersionStatement="select version, modified from dataversion"
+bumpDataVersionStatement="update dataversion set version=version+1, modified=current timestamp - current timezone"
+
+# New data is available, invalidate all cached responses of all instances.
+# Called after the change is committed.
+def bumpDataVersion():
+    with dbTransaction() as connection:
+        connection.execute(bumpDataVersionStatement)
+    # read the new version with the next request
+    dataVersion['checked']=0
+
+# Return the current data version and the time (UTC) it was last modified
+def currentDataVersion():
+    global dataCacheSize
+    now=time.time()
+    if now-dataVersion['checked']>DATA_VERSION_CHECK:
+        row=db.engine.execute(dataVersionStatement).fetchone()
+        dataVersion['checked']=now
+        if row['version']!=dataVersion['version']:
+            with dataCacheLock:
+                dataVersion['version']=row['version']
+                dataVersion['modified']=row['modified'].replace(tzinfo=datetime.timezone.utc).timestamp()
+                dataCache.clear()
+                dataCacheSize=0
+    return dataVersion['version'], dataVersion['modified']
+
+def cacheGet(key):
+    with dataCacheLock:
+        entry=dataCache.get(key)
+        if entry is None:
+            return None
+        dataCache.move_to_end(key)
+        return entry[0]
+
+def cachePut(key, entry, size):
+    global dataCacheSize
+    with dataCacheLock:
+        if key in dataCache:
+            return
+        dataCache[key]=(entry, size)
+        dataCacheSize=dataCacheSize+size
+        while dataCacheSize>DATA_CACHE_BYTES and dataCache:
+            oldKey, (oldEntry, oldSize)=dataCache.popitem(last=False)
+            dataCacheSize=dataCacheSize-oldSize
+
+# Cache key for the current request: user, role, path and the parameters
+# (without the jQuery cache buster "_")
+def requestCacheKey(*extra):
+    args=tuple(sorted((k, v) for k, v in request.args.items(multi=True) if k!='_'))
+    return (flask.session['id_token']['email'], flask.session.get('userrole'), request.path, args)+extra
+
+# Decorator for /data endpoints to serve responses from the cache and to
+# answer conditional requests with 304 Not Modified. DataTables page
+# requests ("draw") are cached by dataTablesPage instead.
+def cached_data(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if DATA_CACHE_BYTES<=0 or 'draw' in request.args:
+            return f(*args, **kwargs)
+        version, modified=currentDataVersion()
+        gzipped=STREAM_GZIP and 'gzip' in request.headers.get('Accept-Encoding', '')
+        key=requestCacheKey(gzipped, version)
+        etag=hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        lastModified=datetime.datetime.fromtimestamp(int(modified), datetime.timezone.utc)
+        if request.if_none_match:
+            if request.if_none_match.contains(etag):
+                return Response(status=304, headers={'ETag': '"'+etag+'"', 'Vary': 'Accept-Encoding'})
+        elif request.if_modified_since and request.if_modified_since>=lastModified:
+            return Response(status=304, headers={'ETag': '"'+etag+'"', 'Vary': 'Accept-Encoding'})
+
+        cached=cacheGet(key)
+        if cached is None:
+            response=make_response(f(*args, **kwargs))
+            if response.status_code!=200:
+                return response
+            # collect the body, but keep streaming if it is too large to cache
+            chunks=[]
+            size=0
+            stream=iter(response.response)
+            for chunk in stream:
+                chunks.append(chunk)
+                size=size+len(chunk)
+                if size>DATA_CACHE_MAX_ENTRY:
+                    response.response=itertools.chain(chunks, stream)
+                    return response
+            body=b''.join(chunks)
+            headers=[(k, v) for k, v in response.headers.items() if k!='Content-Length']
+            cachePut(key, (body, headers), size)
+        else:
+            body, headers=cached
+        response=Response(body, headers=headers)
+        response.set_etag(etag)
+        response.last_modified=lastModified
+        # browsers have to revalidate, but get a 304 while data is unchanged
+        response.headers['Cache-Control']='private, no-cache'
+        return response
+    return decorated_function
+
+# User access
+# The repositories a user may see are kept in the table useraccess, which is
+# refreshed whenever repositories or roles change. User roles are cached in
+# the app for ACCESS_CACHE_TTL seconds.
+userRoles=OrderedDict()
+userRolesLock=threading.Lock()
+
+refreshAccessDeleteRepo="delete from useraccess where rid=?"
+refreshAccessInsertRepo="insert into useraccess (email, rid) select distinct email, rid from v_adminuserrepos where rid=?"
+refreshAccessDeleteAll="delete from useraccess"
+refreshAccessInsertAll="insert into useraccess (email, rid) select distinct email, rid from v_adminuserrepos"
+
+# Update the access index for a repository, a list of repositories or for
+# all repositories if no rid is given. Must be called within the transaction
+# changing them.
+def refreshUserAccess(conn, rid=None):
+    if rid is None:
+        conn.execute(refreshAccessDeleteAll)
+        conn.execute(refreshAccessInsertAll)
+    elif isinstance(rid, list):
+        if rid:
+            conn.execute(refreshAccessDeleteRepo, [(r,) for r in rid])
+            conn.execute(refreshAccessInsertRepo, [(r,) for r in rid])
+    else:
+        conn.execute(refreshAccessDeleteRepo, rid)
+        conn.execute(refreshAccessInsertRepo, rid)
+    with userRolesLock:
+        userRoles.clear()
+
+# Scope for a database transaction on a pooled connection. Commits on
+# success, rolls back on errors and always returns the connection.
+@contextmanager
+def dbTransaction():
+    connection = db.engine.connect()
+    try:
+        trans = connection.begin()
+        try:
+            yield connection
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+    finally:
+        connection.close()
+
+# Usage statistics of the database connection pool
+def dbPoolStatus():
+    pool=db.engine.pool
+    status={'pool': type(pool).__name__, 'events': dict(dbPoolEvents)}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, name):
+            status[name]=getattr(pool, name)()
+    return status
 
 # Set the role for the current session user
 def setuserrole(email=None):
+    with userRolesLock:
+        cached=userRoles.get(email)
+    if cached is not None and time.time()-cached[1]<ACCESS_CACHE_TTL:
+        flask.session['userrole']=cached[0]
+        return flask.session['userrole']
     flask.session['userrole']=0
     try:
         result = db.engine.execute("select role from adminroles ar, adminusers au where ar.aid=au.aid and au.email=?",email)
@@ -243,6 +717,11 @@ def setuserrole(email=None):
     except:
         app.logger.error("Db2 error")
         raise
+    with userRolesLock:
+        userRoles[email]=(flask.session['userrole'], time.time())
+        userRoles.move_to_end(email)
+        while len(userRoles)>ACCESS_CACHE_SIZE:
+            userRoles.popitem(last=False)
     return flask.session['userrole']
 
 # Check for userrole
@@ -312,25 +791,24 @@ def secondstep():
 
     dbstatements = sqlcode.split(';') # split the text into commands
 
-    connection = db.engine.connect()
-    trans = connection.begin()
     try:
-        # We are going to execute each of the DB schema-related statements,
-        # thereby creating the database structures and some configuration data.
-        # If there is an error, it means that the required setup has not between
-        # done or the environment has been already set up.
-        for stmt in dbstatements:
-            connection.execute(stmt)
-        connection.execute("insert into adminusers (aid, auser, email) values(?,?,?)", 100, username, flask.session['id_token']['email'])
-        connection.execute("insert into tenants (tid, ghuser, ghtoken) values(?,?,?)", 100, ghuser, ghtoken)
-        connection.execute("insert into adminroles (aid, role) values(?,?)", 100, 5)
-        # Adminuser has tentant role for the tenant (user)
-        connection.execute("insert into admintenantreporoles (aid, tid, role) values(?,?,?)", 100, 100, 4)
-        trans.commit()
+        with dbTransaction() as connection:
+            # We are going to execute each of the DB schema-related statements,
+            # thereby creating the database structures and some configuration data.
+            # If there is an error, it means that the required setup has not between
+            # done or the environment has been already set up.
+            for stmt in dbstatements:
+                connection.execute(stmt)
+            connection.execute("insert into adminusers (aid, auser, email) values(?,?,?)", 100, username, flask.session['id_token']['email'])
+            connection.execute("insert into tenants (tid, ghuser, ghtoken) values(?,?,?)", 100, ghuser, ghtoken)
+            connection.execute("insert into adminroles (aid, role) values(?,?)", 100, 5)
+            # Adminuser has tentant role for the tenant (user)
+            connection.execute("insert into admintenantreporoles (aid, tid, role) values(?,?,?)", 100, 100, 4)
+            refreshUserAccess(connection)
     except:
-        trans.rollback()
         # for now ignore error and return to index page, but ideally report error and return to welcome page
         return redirect(url_for('index'))
+    bumpDataVersion()
     # Have to set userrole because now the data is ready
     setuserrole(flask.session['id_token']['email'])
     return redirect(url_for('listrepos'))
@@ -368,6 +846,27 @@ def newtenant():
         return render_template('notavailable.html', message="You are not authorized.") # should go to error or info page
 
 
+# Metrics in the Prometheus text format
+@app.route('/metrics')
+def metrics():
+    if not METRICS_TOKEN or request.headers.get('Authorization')!='Bearer '+METRICS_TOKEN:
+        return "no success",403
+    if ALL_CONFIGURED:
+        status=dbPoolStatus()
+        for state in ('checkedin', 'checkedout', 'overflow'):
+            if state in status:
+                setMetric('ghstats_db_pool_connections', status[state], state=state)
+    return Response(renderMetrics(), mimetype='text/plain; version=0.0.4')
+
+# Report database connection pool usage
+@app.route('/admin/dbpool')
+@security_decorator_auth
+def dbpool():
+    if isSysMaintainer() or isAdministrator():
+        return jsonify(dbPoolStatus())
+    else:
+        return jsonify(message="You are not authorized."),403
+
 # Show table with system logs
 @app.route('/admin/systemlog')
 @security_decorator_auth
@@ -398,6 +897,15 @@ def repostatistics_weekly():
         return render_template('notavailable.html', message="You are not authorized.") # should go to error or info page
 
 
+# return page with the monthly repository stats
+@app.route('/repos/statsmonthly')
+@security_decorator_auth
+def repostatistics_monthly():
+    if isTenant() or isTenantViewer() or isRepoViewer():
+        return render_template('repostatsmonth.html')
+    else:
+        return render_template('notavailable.html', message="You are not authorized.") # should go to error or info page
+
 
 # Show list of managed repositories
 @app.route('/repos')
@@ -421,9 +929,7 @@ def newrepo():
         # could check if repo exists
         # but skipping to reduce complexity
 
-        connection = db.engine.connect()
-        trans = connection.begin()
-        try:
+        with dbTransaction() as connection:
             tid=None
             rid=None
             orgid=None
@@ -448,17 +954,120 @@ def newrepo():
             for row in repoid:
                 rid=row['rid']
             repoid = connection.execute("insert into tenantrepos values(?,?)",tid,rid)
-            trans.commit()
-        except:
-            trans.rollback()
-            raise
+            refreshUserAccess(connection, rid)
+        bumpDataVersion()
         # Log to stdout stream
         print("Created repo with id "+str(rid))
         return jsonify(message="Your new repo ID: "+str(rid), repoid=rid)
     else:
         return jsonify(message="Error: no repository added") # should go to error or info page
 
+# Statements for adding repositories in bulk
+tenantInfoStmt="""select atrr.tid, t.ghuser, t.ghtoken
+                  from admintenantreporoles atrr, adminusers au, tenants t
+                  where atrr.aid=au.aid
+                  and t.tid=atrr.tid
+                  and bitand(atrr.role,4)>0
+                  and au.email=?"""
+tenantRepoNamesStmt="""select gu.username, r.rname from tenantrepos tr, repos r, ghorgusers gu
+                       where tr.rid=r.rid and r.oid=gu.oid and tr.tid=?"""
+
+# Split a list into parts of the given size
+def batches(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start+size]
+
+# List all repositories of a GitHub org or user, following the pages
+def github_list_repos(username, access_token, orgname):
+    path=f"/orgs/{orgname}/repos"
+    page=1
+    while True:
+        response=github_get(username, access_token, path, params={'per_page': 100, 'page': page, 'type': 'all'})
+        if response.status_code==404 and page==1 and path.startswith("/orgs/"):
+            # not an organization, try as user
+            path=f"/users/{orgname}/repos"
+            continue
+        response.raise_for_status()
+        repos=response.json()
+        for repo in repos:
+            yield repo['owner']['login'], repo['name']
+        if len(repos)<100:
+            return
+        page=page+1
+
+# Add many repositories at once, either given as "org/repo" lines in the
+# form field "repos" or all repositories of the org (or user) "orgname".
+# Orgs are resolved once and repositories already tracked by the tenant
+# are skipped. Like newrepo, each repository gets a new record of its own.
+# All inserts happen in batches within one transaction.
+@app.route('/api/newrepos', methods=['POST'])
+@security_decorator_auth
+def newrepos():
+    if not isTenant():
+        return jsonify(message="Error: no repository added") # should go to error or info page
+    with dbTransaction() as connection:
+        tenant=connection.execute(tenantInfoStmt,flask.session['id_token']['email']).fetchone()
+        if tenant is None:
+            return jsonify(message="Error: no repository added")
+        tid=tenant['tid']
+
+        # collect the requested org/repo pairs
+        wanted=[]
+        orgname=request.form.get('orgname', '').strip()
+        if orgname:
+            try:
+                wanted=list(github_list_repos(tenant['ghuser'], tenant['ghtoken'], orgname))
+            except Exception as e:
+                return jsonify(message="Error: cannot list repositories of "+orgname+": "+str(e)),502
+        for line in request.form.get('repos', '').splitlines():
+            if line.strip().count('/')==1:
+                org, repo=[part.strip() for part in line.strip().split('/')]
+                if org and repo:
+                    wanted.append((org, repo))
+
+        # skip duplicates and what the tenant already has
+        known=set((row['username'], row['rname']) for row in connection.execute(tenantRepoNamesStmt, tid))
+        pairs=[]
+        for pair in wanted:
+            if pair not in known:
+                known.add(pair)
+                pairs.append(pair)
+        if not pairs:
+            return jsonify(message="No new repositories", added=[], skipped=len(wanted))
+
+        # resolve the org ids once, create missing orgs
+        orgids={}
+        orgnames=sorted(set(org for org, repo in pairs))
+        for part in batches(orgnames, 100):
+            stmt="select oid, username from ghorgusers where username in ("+",".join("?"*len(part))+")"
+            for row in connection.execute(stmt, *part):
+                orgids[row['username']]=row['oid']
+        missing=[org for org in orgnames if org not in orgids]
+        for part in batches(missing, 100):
+            stmt="select oid, username from new table (insert into ghorgusers(username) values "+",".join(["(?)"]*len(part))+")"
+            for row in connection.execute(stmt, *part):
+                orgids[row['username']]=row['oid']
+
+        # new repository records for the tenant
+        rids={}
+        for part in batches(pairs, 100):
+            stmt="select rid, oid, rname from new table (insert into repos(rname,ghserverid,oid,schedule) values "+",".join(["(?,?,?,?)"]*len(part))+")"
+            params=[value for org, repo in part for value in (repo, 1, orgids[org], 0)]
+            for row in connection.execute(stmt, *params):
+                rids[(row['oid'], row['rname'])]=row['rid']
+
+        added=[{'repoid': rids[(orgids[org], repo)], 'orgname': org, 'reponame': repo} for org, repo in pairs]
+        connection.execute("insert into tenantrepos values(?,?)", [(tid, a['repoid']) for a in added])
+        refreshUserAccess(connection, [a['repoid'] for a in added])
+    bumpDataVersion()
+    # Log to stdout stream
+    print("Created "+str(len(added))+" repos for tenant "+str(tid))
+    return jsonify(message="Added "+str(len(added))+" repositories, skipped "+str(len(wanted)-len(added)),
+                   added=added, skipped=len(wanted)-len(added))
+
 # Process the request to delete a repository
+# The repository is only marked as deleted and hidden, its traffic data
+# is purged by a background job (see purgeDeletedRepos).
 @app.route('/api/deleterepo', methods=['POST'])
 @security_decorator_auth
 def deleterepo():
@@ -471,25 +1080,18 @@ def deleterepo():
         # could check if repo exists
         # but skipping to reduce complexity
 
-        # delete from repos, tenantrepos and every row in adminuserreporoles
+        # mark the repo, delete from tenantrepos and every row in adminuserreporoles
 
-        connection = db.engine.connect()
-        trans = connection.begin()
-        try:
-            # delete the repo record
-            connection.execute("delete from repos where rid=?",repoid)
+        with dbTransaction() as connection:
+            # mark the repo record for the purge
+            connection.execute("update repos set deleted=current timestamp where rid=? and deleted is null",repoid)
             # delete the relationship information
             connection.execute("delete from tenantrepos where rid=?",repoid)
             # delete the role information
             connection.execute("delete from admintenantreporoles where rid=?",repoid)
-            # delete related traffic data
-            # IDEA: This app could be extended to ask whether to keep this data.
-            connection.execute("delete from repotraffic where rid=?",repoid)
-
-            trans.commit()
-        except:
-            trans.rollback()
-            raise
+            refreshUserAccess(connection, repoid)
+        bumpDataVersion()
+        startPurgeJob()
         return jsonify(message="Deleted repository: "+str(repoid), repoid=repoid)
     else:
         return jsonify(message="Error: no repository deleted") # should go to error or info page
@@ -506,130 +1108,358 @@ def generate_user():
 
 # Common statement to generate statistics
 statstmt="""select r.rid,r.tdate,r.viewcount,r.vuniques,r.clonecount,r.cuniques
-            from v_repostats r, v_adminuserrepos v
+            from v_repostats r, useraccess v
             where r.rid=v.rid
             and v.email=? """
 
 statsFullOrgStmt="""select r.rid,r.orgname,r.reponame,r.tdate,r.viewcount,r.vuniques,r.clonecount,r.cuniques
-                    from v_repostats r, v_adminuserrepos v
+                    from v_repostats r, useraccess v
                     where r.rid=v.rid
                     and v.email=? """
 
+# Repositories failing to be collected
+failuresStmt="""select f.rid, gu.username as orgname, r.rname as reponame, f.status, f.failures,
+                f.skipruns, f.quarantined, f.lastfailed, f.message
+                from repofailures f, repos r, ghorgusers gu
+                where f.rid=r.rid and r.oid=gu.oid
+                order by f.quarantined desc, f.failures desc, f.rid asc"""
+
 logstmt="""select tid, completed, numrepos, state
            from systemlog where completed >(current date - ? days)
            order by completed desc, tid asc
            """
 # Common statement to generate list of repositories
-repolist_stmt="""select rid,orgname, reponame
-                 from v_adminrepolist
-                 where email=? order by rid asc"""
-
-# Traffic by work week
-statsWorkWeek="""select r.rid,orgname,reponame,varchar_format(tdate,'YYYY-IW') as workweek,
-                 sum(viewcount) as viewcount, sum(vuniques) as vuniques, sum(clonecount) as clonecount, sum(cuniques) as cuniques
-                 from v_repostats r, v_adminuserrepos v
-                 where r.rid=v.rid
-                 and v.email=?
-                 group by r.rid, varchar_format(tdate,'YYYY-IW'), orgname, reponame"""
-
-
+repolist_stmt="""select r.rid, gu.username as orgname, r.rname as reponame
+                 from repos r, ghorgusers gu, useraccess v
+                 where r.oid=gu.oid and v.rid=r.rid
+                 and v.email=? order by r.rid asc"""
+
+# Traffic by work week, read from the weekly rollup
+statsWorkWeek="""select r.rid,gu.username as orgname,r.rname as reponame,varchar_format(w.weekstart,'IYYY-IW') as workweek,
+                 w.viewcount, w.vuniques, w.clonecount, w.cuniques
+                 from repotrafficweekly w, repos r, ghorgusers gu, useraccess v
+                 where w.rid=r.rid and r.oid=gu.oid
+                 and w.rid=v.rid
+                 and v.email=?"""
+
+# Traffic by month, read from the monthly rollup
+statsMonth="""select r.rid,gu.username as orgname,r.rname as reponame,varchar_format(m.monthstart,'YYYY-MM') as month,
+              m.viewcount, m.vuniques, m.clonecount, m.cuniques
+              from repotrafficmonthly m, repos r, ghorgusers gu, useraccess v
+              where m.rid=r.rid and r.oid=gu.oid
+              and m.rid=v.rid
+              and v.email=?"""
+
+
+
+# Columns of the statistics tables in the order the DataTables show them.
+# The search columns are matched against the search term.
+statsColumns=["rid","orgname","reponame","tdate","viewcount","vuniques","clonecount","cuniques"]
+statsSearchColumns=["orgname","reponame","varchar_format(tdate,'YYYY-MM-DD')"]
+statsWorkWeekColumns=["rid","orgname","reponame","workweek","viewcount","vuniques","clonecount","cuniques"]
+statsWorkWeekSearchColumns=["orgname","reponame","workweek"]
+statsMonthColumns=["rid","orgname","reponame","month","viewcount","vuniques","clonecount","cuniques"]
+statsMonthSearchColumns=["orgname","reponame","month"]
+
+# Escape the wildcard characters for a LIKE predicate with escape '!'
+def likePattern(term):
+    return '%'+term.replace('!','!!').replace('%','!%').replace('_','!_')+'%'
+
+# DataTables server-side processing: return a single page of the results
+# of the given statement, sorted and filtered by the database.
+# See https://datatables.net/manual/server-side for the parameters.
+def dataTablesPage(stmt, columns, searchColumns, *params):
+    search=request.args.get('search[value]', '').strip().lower()
+
+    # only accept known columns, repository and date are added as
+    # tie-breakers to get a stable order for paging
+    order=[]
+    try:
+        draw=int(request.args.get('draw', 0))
+        start=max(int(request.args.get('start', 0)), 0)
+        length=int(request.args.get('length', 10))
+        i=0
+        while 'order[%d][column]' % i in request.args:
+            col=int(request.args['order[%d][column]' % i])
+            direction='desc' if request.args.get('order[%d][dir]' % i)=='desc' else 'asc'
+            if 0<=col<len(columns) and columns[col] not in [o.split()[0] for o in order]:
+                order.append(columns[col]+' '+direction)
+            i=i+1
+    except ValueError:
+        return jsonify(message="Error: invalid parameters"),400
+    for col in (columns[0], columns[3]):
+        if col not in [o.split()[0] for o in order]:
+            order.append(col+' asc')
+
+    # the page content is cached without the draw counter
+    cacheKey=None
+    if DATA_CACHE_BYTES>0:
+        version, modified=currentDataVersion()
+        cacheKey=(stmt, params, start, length, tuple(order), search, version)
+        cached=cacheGet(cacheKey)
+        if cached is not None:
+            return dataTablesResponse(draw, *cached)
+
+    recordsTotal=list(dataQuery("select count(*) from ("+stmt+") t", *params, query='total'))[0][0]
+    pageStmt="select * from ("+stmt+") t"
+    pageParams=list(params)
+    recordsFiltered=recordsTotal
+    if search:
+        pageStmt=pageStmt+" where "+" or ".join(["lower("+c+") like ? escape '!'" for c in searchColumns])
+        pageParams=pageParams+[likePattern(search)]*len(searchColumns)
+        recordsFiltered=list(dataQuery("select count(*) from ("+pageStmt+") f", *pageParams, query='filtered'))[0][0]
+    pageStmt=pageStmt+" order by "+", ".join(order)
+    if length>0:
+        pageStmt=pageStmt+" offset ? rows fetch first ? rows only"
+        pageParams=pageParams+[start, length]
+    result=dataQuery(pageStmt, *pageParams, query='page')
+    data=b''.join(jsonRowChunks(result, prefix=b'', suffix=b''))
+    if cacheKey is not None and len(data)<=DATA_CACHE_MAX_ENTRY:
+        cachePut(cacheKey, (recordsTotal, recordsFiltered, data), len(data))
+    return dataTablesResponse(draw, recordsTotal, recordsFiltered, data)
+
+# Response for DataTables server-side processing with already encoded rows
+def dataTablesResponse(draw, recordsTotal, recordsFiltered, data):
+    prefix=b'{"draw":'+encodeJSON(draw)+b',"recordsTotal":'+encodeJSON(recordsTotal)+ \
+           b',"recordsFiltered":'+encodeJSON(recordsFiltered)+b',"data":[\n'
+    return streamResponse([prefix, data, b']}'], 'application/json')
+
+
+# DataTables response without any rows, for users without access
+def dataTablesEmpty():
+    try:
+        draw=int(request.args['draw'])
+    except ValueError:
+        return jsonify(message="Error: invalid parameters"),400
+    return jsonify(draw=draw, recordsTotal=0, recordsFiltered=0, data=[])
 
 # return the repository statistics for the web page, dynamically loaded
+# With the DataTables "draw" parameter only the requested page is returned.
 @app.route('/data/repostats.txt')
 @security_decorator_auth
+@cached_data
 def generate_data_repostats_txt():
-    def generate():
-        yield '{ "data": [\n'
+    if 'draw' in request.args:
         if isTenant() or isTenantViewer() or isRepoViewer():
-            result = db.engine.execute(statsFullOrgStmt,flask.session['id_token']['email'])
-            first=True
-            for row in result:
-                if not first:
-                    yield ',\n'
-                else:
-                    first=False
-                yield '["'+'","'.join(map(str,row)) + '"]'
-        yield ']}'
-    return Response(stream_with_context(generate()), mimetype='text/utf-8')
+            return dataTablesPage(statsFullOrgStmt, statsColumns, statsSearchColumns, flask.session['id_token']['email'])
+        return dataTablesEmpty()
+    result=[]
+    if isTenant() or isTenantViewer() or isRepoViewer():
+        result = dataQuery(statsFullOrgStmt,flask.session['id_token']['email'])
+    return streamResponse(jsonRowChunks(result), 'application/json')
 
 # return the repository statistics for the web page, dynamically loaded
 @app.route('/data/repostatsWorkWeek.txt')
 @security_decorator_auth
+@cached_data
 def generate_data_repostatsWorkWeek_txt():
-    def generate():
-        yield '{ "data": [\n'
+    if 'draw' in request.args:
         if isTenant() or isTenantViewer() or isRepoViewer():
-            result = db.engine.execute(statsWorkWeek,flask.session['id_token']['email'])
-            first=True
-            for row in result:
-                if not first:
-                    yield ',\n'
-                else:
-                    first=False
-                yield '["'+'","'.join(map(str,row)) + '"]'
-        yield ']}'
-    return Response(stream_with_context(generate()), mimetype='text/utf-8')
+            return dataTablesPage(statsWorkWeek, statsWorkWeekColumns, statsWorkWeekSearchColumns, flask.session['id_token']['email'])
+        return dataTablesEmpty()
+    result=[]
+    if isTenant() or isTenantViewer() or isRepoViewer():
+        result = dataQuery(statsWorkWeek,flask.session['id_token']['email'])
+    return streamResponse(jsonRowChunks(result), 'application/json')
 
+# return the monthly repository statistics for the web page, dynamically loaded
+@app.route('/data/repostatsMonth.txt')
+@security_decorator_auth
+@cached_data
+def generate_data_repostatsMonth_txt():
+    if 'draw' in request.args:
+        if isTenant() or isTenantViewer() or isRepoViewer():
+            return dataTablesPage(statsMonth, statsMonthColumns, statsMonthSearchColumns, flask.session['id_token']['email'])
+        return dataTablesEmpty()
+    result=[]
+    if isTenant() or isTenantViewer() or isRepoViewer():
+        result = dataQuery(statsMonth,flask.session['id_token']['email'])
+    return streamResponse(jsonRowChunks(result), 'application/json')
 
 # return the system logs for the web page, dynamically loaded
 @app.route('/data/systemlogs.txt')
 @security_decorator_auth
 def generate_data_systemlogs_txt():
     if isAdministrator() or isSysMaintainer():
-        def generate():
-            result = db.engine.execute(logstmt,30)
-            first=True
-            yield '{ "data": [\n'
-            for row in result:
-                if not first:
-                    yield ',\n'
-                else:
-                    first=False
-                yield '["'+'","'.join(map(str,row)) + '"]'
-            yield ']}'
-        return Response(stream_with_context(generate()), mimetype='text/utf-8')
+        result = dataQuery(logstmt,30)
+        return streamResponse(jsonRowChunks(result), 'application/json')
     else:
         return render_template('notavailable.html', message="You are not authorized.")
 
+# return the repositories failing to be collected, dynamically loaded
+@app.route('/data/repofailures.txt')
+@security_decorator_auth
+def generate_data_repofailures_txt():
+    if isAdministrator() or isSysMaintainer():
+        result = dataQuery(failuresStmt)
+        return streamResponse(jsonRowChunks(result), 'application/json')
+    else:
+        return render_template('notavailable.html', message="You are not authorized.")
+
+# Release a failing repository, it is collected again with the next run
+@app.route('/api/releaserepo', methods=['POST'])
+@security_decorator_auth
+def releaserepo():
+    if isAdministrator() or isSysMaintainer():
+        repoid=request.form['repoid']
+        with dbTransaction() as connection:
+            connection.execute(clearFailureStatement, repoid)
+        print("Released repo with id "+str(repoid))
+        return jsonify(message="Released repository: "+str(repoid), repoid=repoid)
+    else:
+        return jsonify(message="Error: no repository released")
+
 # return the repository statistics for the current user as csv file
 @app.route('/data/repostats.csv')
 @security_decorator_auth
+@cached_data
 def generate_repostats():
-    def generate():
-        yield "RID,TDATE,VIEWCOUNT,VUNIQUES,CLONECOUNT,CUNIQUES\n"
-        if isTenant() or isTenantViewer() or isRepoViewer():
-            result = db.engine.execute(statstmt,flask.session['id_token']['email'])
-            for row in result:
-                yield ','.join(map(str,row)) + '\n'
-    return Response(stream_with_context(generate()), mimetype='text/csv')
+    result=[]
+    if isTenant() or isTenantViewer() or isRepoViewer():
+        result = dataQuery(statstmt,flask.session['id_token']['email'])
+    return streamResponse(csvRowChunks(result, ["RID","TDATE","VIEWCOUNT","VUNIQUES","CLONECOUNT","CUNIQUES"]), 'text/csv')
 
 # Generate list of repositories for web page, dynamically loaded
 @app.route('/data/repositories.txt')
 @security_decorator_auth
+@cached_data
 def generate_data_repolist_txt():
-    def generate():
-        result = db.engine.execute(repolist_stmt,flask.session['id_token']['email'])
-        first=True
-        yield '{ "data": [\n'
-        for row in result:
-            if not first:
-                yield ',\n'
-            else:
-                first=False
-            yield '["'+'","'.join(map(str,row)) + '"]'
-        yield ']}'
-    return Response(stream_with_context(generate()), mimetype='text/utf-8')
+    result = dataQuery(repolist_stmt,flask.session['id_token']['email'])
+    return streamResponse(jsonRowChunks(result), 'application/json')
 
 # Export repositories as CSV file
 @app.route('/data/repositories.csv')
 @security_decorator_auth
 def generate_repolist():
-    def generate():
-        result = db.engine.execute(repolist_stmt,flask.session['id_token']['email'])
-        yield "RID,ORGNAME,REPONAME\n"
-        for row in result:
-            yield ','.join(map(str,row)) + '\n'
-    return Response(stream_with_context(generate()), mimetype='text/csv')
+    result = dataQuery(repolist_stmt,flask.session['id_token']['email'])
+    return streamResponse(csvRowChunks(result, ["RID","ORGNAME","REPONAME"]), 'text/csv')
+
+# Export of the traffic history
+exportStmt="""select r.rid, gu.username as orgname, r.rname as reponame, rt.tdate,
+              rt.viewcount, rt.vuniques, rt.clonecount, rt.cuniques
+              from repotraffic rt, repos r, ghorgusers gu, useraccess v
+              where rt.rid=r.rid and r.oid=gu.oid
+              and rt.rid=v.rid
+              and v.email=?
+              and rt.tdate between ? and ? {conditions}
+              order by r.rid, rt.tdate"""
+exportColumns=["RID","ORGNAME","REPONAME","TDATE","VIEWCOUNT","VUNIQUES","CLONECOUNT","CUNIQUES"]
+
+# Column types of the columnar export formats
+def exportSchema():
+    return pyarrow.schema([('rid', pyarrow.int32()), ('orgname', pyarrow.string()), ('reponame', pyarrow.string()),
+                           ('tdate', pyarrow.date32()), ('viewcount', pyarrow.int32()), ('vuniques', pyarrow.int32()),
+                           ('clonecount', pyarrow.int32()), ('cuniques', pyarrow.int32())])
+
+# File-like target for the pyarrow writers. Written data is collected until
+# it is drained, but the position keeps counting for the Parquet footer.
+class ExportSink:
+    def __init__(self):
+        self.chunks=[]
+        self.position=0
+        self.closed=False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position=self.position+len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed=True
+
+    def drain(self):
+        data=b''.join(self.chunks)
+        self.chunks=[]
+        return data
+
+# Serialize result rows as Parquet or Arrow IPC stream, one row group or
+# record batch per EXPORT_BATCH_ROWS rows
+def columnarChunks(rows, fileformat):
+    schema=exportSchema()
+    sink=ExportSink()
+    target=pyarrow.PythonFile(sink, mode='w')
+    if fileformat=='parquet':
+        writer=pyarrow.parquet.ParquetWriter(target, schema, compression='zstd')
+    else:
+        writer=pyarrow.ipc.new_stream(target, schema)
+    rows=iter(rows)
+    while True:
+        batch=list(itertools.islice(rows, EXPORT_BATCH_ROWS))
+        if not batch:
+            break
+        columns=[pyarrow.array([row[i] for row in batch], type=field.type) for i, field in enumerate(schema)]
+        records=pyarrow.RecordBatch.from_arrays(columns, schema=schema)
+        if fileformat=='parquet':
+            writer.write_table(pyarrow.Table.from_batches([records]))
+        else:
+            writer.write_batch(records)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+# Export the traffic history the user has access to
+# Parameters (all optional):
+# - from, to: date range as YYYY-MM-DD, the full history by default
+# - rid: repository ID, can be repeated
+# - org: organisation or user name
+# - format: csv, parquet or arrow (Arrow IPC stream), csv by default
+# - compress: gzip for a .csv.gz file, only with format csv
+# Rows are streamed from the database cursor and serialized in batches.
+@app.route('/data/export')
+@security_decorator_auth
+def export_data():
+    if not (isTenant() or isTenantViewer() or isRepoViewer()):
+        return jsonify(message="You are not authorized."),403
+    try:
+        fromdate=datetime.date.fromisoformat(request.args.get('from', '0001-01-01'))
+        todate=datetime.date.fromisoformat(request.args.get('to', datetime.date.today().isoformat()))
+        rids=[int(rid) for rid in request.args.getlist('rid')]
+        fileformat=request.args.get('format', 'csv')
+        compress=request.args.get('compress')
+        if fileformat not in ('csv', 'parquet', 'arrow') or compress not in (None, 'gzip'):
+            raise ValueError(fileformat)
+        # Parquet and Arrow are compressed by their writers
+        if compress is not None and fileformat!='csv':
+            raise ValueError(compress)
+    except ValueError:
+        return jsonify(message="Error: invalid parameters"),400
+    if fileformat!='csv' and pyarrow is None:
+        return jsonify(message="Error: format "+fileformat+" not available"),501
+
+    conditions=""
+    params=[flask.session['id_token']['email'], fromdate, todate]
+    if rids:
+        conditions=conditions+" and rt.rid in ("+",".join("?"*len(rids))+")"
+        params=params+rids
+    if request.args.get('org'):
+        conditions=conditions+" and gu.username=?"
+        params.append(request.args['org'])
+    result=dataQuery(exportStmt.format(conditions=conditions), *params)
+
+    filename="repotraffic-"+fromdate.isoformat()+"-"+todate.isoformat()
+    if fileformat=='csv':
+        chunks=csvRowChunks(result, exportColumns)
+        if compress=='gzip':
+            response=Response(stream_with_context(gzipChunks(chunks)), mimetype='application/gzip')
+            filename=filename+".csv.gz"
+        else:
+            response=streamResponse(chunks, 'text/csv')
+            filename=filename+".csv"
+    elif fileformat=='parquet':
+        # compressed already
+        response=Response(stream_with_context(columnarChunks(result, 'parquet')), mimetype='application/vnd.apache.parquet')
+        filename=filename+".parquet"
+    else:
+        response=streamResponse(columnarChunks(result, 'arrow'), 'application/vnd.apache.arrow.stream')
+        filename=filename+".arrows"
+    response.headers['Content-Disposition']='attachment; filename='+filename
+    return response
 
 # handle images correctly, some are expected at /images
 @app.route('/images/<path:path>')
@@ -657,125 +1487,641 @@ def error(error=None, error_description=None):
 #######
 # SQL statements
 #
-# fetch all users
-allTenantsStatement="select tid, ghuser, ghtoken from tenants"
-# fetch all repos for a given userID
-allReposStatement="select r.rid, ghu.username, r.rname from tenantrepos tr,repos r, ghorgusers ghu where tr.rid=r.rid and r.oid=ghu.oid and tr.tid=?"
-
-# merge the view traffic data
-mergeViews1="merge into repotraffic rt using (values"
-mergeViews2=""") as nv(rid,viewdate,viewcount,uniques) on rt.rid=nv.rid and rt.tdate=nv.viewdate
-            when matched and nv.viewcount>rt.viewcount then update set viewcount=nv.viewcount, vuniques=coalesce(nv.uniques,0)
-            when not matched then insert (rid,tdate,viewcount, vuniques) values(nv.rid,nv.viewdate,coalesce(nv.viewcount,0),coalesce(nv.uniques,0))
+
+# collection runs and their work queue
+lockRunsStatement="lock table collectruns in exclusive mode"
+abandonRunsStatement="update collectruns set state='abandoned' where state='running' and updated<=(current timestamp - ? hours)"
+lastRunStatement="select runid from collectruns where state='running' order by runid desc fetch first 1 row only"
+newRunStatement="select runid from new table (insert into collectruns(started,updated,state) values(current timestamp,current timestamp,'running'))"
+touchRunStatement="update collectruns set updated=current timestamp where runid=?"
+finishRunStatement="update collectruns set updated=current timestamp, state=? where runid=? and state='running'"
+clearWorkStatement="delete from collectwork where runid<?"
+# tiers in repos.schedule: 0 hot, 1 warm, 2 cold
+# Repositories without a stored traffic window have never been collected.
+updateScheduleStatement="""update repos r set schedule=
+                           case when not exists (select 1 from repowindow w where w.rid=r.rid) then 0
+                           else (select case when coalesce(sum(rt.viewcount+rt.clonecount),0)>=? then 0
+                                             when coalesce(sum(rt.viewcount+rt.clonecount),0)>0 then 1
+                                             else 2 end
+                                 from repotraffic rt where rt.rid=r.rid and rt.tdate>current date - ? days) end
+                           where r.deleted is null"""
+# One entry per distinct GitHub repository, even if several tenants track
+# it (possibly as different repository records). The entry refers to the
+# lowest rid and tenant, whose token is used to fetch the traffic.
+# Warm and cold repositories are collected once the given hours passed
+# since the start of the run that last collected them, repositories with
+# a record never collected right away.
+# Failing repositories are left out while quarantined or backing off, but
+# not for longer than the given hours since their last failure.
+enqueueWorkStatement="""insert into collectwork (runid,tid,rid,state,attempts)
+                        select ?, min(tr.tid), min(r.rid), 'pending', 0 from tenantrepos tr, tenants t, repos r
+                        where tr.tid=t.tid and tr.rid=r.rid and r.deleted is null
+                        group by r.oid, r.rname
+                        having min(r.rid) not in (select rid from repofailures where quarantined='Y'
+                                                  or (skipruns>0 and lastfailed>current timestamp - cast(? as int) hours))
+                        and (min(r.schedule)=0 or count(r.lastcollected)<count(*)
+                             or min(r.lastcollected)<=current timestamp - (case when min(r.schedule)=1 then cast(? as int) else cast(? as int) end) hours)"""
+# one run less to skip for repositories backing off
+backoffStatement="update repofailures set skipruns=skipruns-1 where skipruns>0 and quarantined='N'"
+# count a failure, the runs to skip double with each 4xx failure in a row,
+# other errors are not backed off
+recordFailureStatement="""merge into repofailures f
+            using (values(cast(? as int),cast(? as int),cast(? as varchar(255)))) as nf(rid,status,message) on f.rid=nf.rid
+            when matched then update set status=nf.status, message=nf.message, failures=f.failures+1,
+                skipruns=case when nf.status between 400 and 499 then least(power(2,least(f.failures,20)), cast(? as int)) else 0 end,
+                lastfailed=current timestamp,
+                quarantined=case when f.failures+1>=cast(? as int) and nf.status in (403,404,410,451) then 'Y' else 'N' end
+            when not matched then insert (rid,status,message,failures,skipruns,firstfailed,lastfailed,quarantined)
+                values(nf.rid,nf.status,nf.message,1,case when nf.status between 400 and 499 then 1 else 0 end,
+                       current timestamp,current timestamp,'N')"""
+clearFailureStatement="delete from repofailures where rid=?"
+# lease the next batch of pending entries or those with an expired lease
+claimWorkStatement="""update (select state, owner, leaseuntil, attempts from collectwork
+                      where runid=? and (state='pending' or (state='leased' and leaseuntil<current timestamp))
+                      order by tid, rid fetch first ? rows only)
+                      set state='leased', owner=?, leaseuntil=current timestamp + ? seconds, attempts=attempts+1"""
+# entries whose leases expired too often are given up
+failExhaustedWorkStatement="""select rid from final table (update collectwork set state='failed', owner=null, leaseuntil=null
+                              where runid=? and state='leased' and leaseuntil<current timestamp and attempts>=?)"""
+# repositories deleted after the run started, or left without any record
+# to merge into, are not collected. All entries still leased afterwards are
+# part of the claimed work.
+skipIdleWorkStatement="""update collectwork w set state='skipped', owner=null, leaseuntil=null
+                         where runid=? and owner=? and state='leased'
+                         and not exists (select 1 from tenants t, repos wr, repos r, ghorgusers ghu
+                                         where t.tid=w.tid and wr.rid=w.rid and wr.deleted is null
+                                         and r.oid=wr.oid and r.rname=wr.rname and r.deleted is null and ghu.oid=r.oid
+                                         and exists (select 1 from tenantrepos tr where tr.rid=r.rid))"""
+# the leased entries with all repository records to merge the traffic into
+claimedWorkStatement="""select w.tid, t.ghuser, t.ghtoken, w.rid as workrid, r.rid, ghu.username, r.rname,
+                        rw.digest, rw.days, rw.viewetag, rw.cloneetag, f.failures
+                        from collectwork w join tenants t on w.tid=t.tid
+                        left outer join repofailures f on f.rid=w.rid
+                        join repos wr on w.rid=wr.rid
+                        join repos r on r.oid=wr.oid and r.rname=wr.rname and r.deleted is null
+                        join ghorgusers ghu on r.oid=ghu.oid
+                        left outer join repowindow rw on rw.rid=r.rid
+                        where w.runid=? and w.owner=? and w.state='leased'
+                        and exists (select 1 from tenantrepos tr where tr.rid=r.rid)
+                        order by w.tid, w.rid, r.rid"""
+# other tenants tracking the leased repositories, their tokens are tried
+# when the token of the entry is denied access
+fallbackTenantsStatement="""select distinct w.rid as workrid, t.tid, t.ghuser, t.ghtoken
+                            from collectwork w join repos wr on w.rid=wr.rid
+                            join repos r on r.oid=wr.oid and r.rname=wr.rname and r.deleted is null
+                            join tenantrepos tr on tr.rid=r.rid
+                            join tenants t on tr.tid=t.tid
+                            where w.runid=? and w.owner=? and w.state='leased' and t.tid<>w.tid
+                            order by w.rid, t.tid"""
+renewLeaseStatement="update collectwork set leaseuntil=current timestamp + ? seconds where runid=? and owner=? and state='leased'"
+markCollectedStatement="update repos set lastcollected=(select started from collectruns where runid=?) where rid=?"
+completeWorkStatement="update collectwork set state=?, owner=null, leaseuntil=null where runid=? and tid=? and rid=? and owner=?"
+releaseWorkStatement="update collectwork set state='pending', owner=null, leaseuntil=null where runid=? and owner=? and state='leased'"
+# entries of the run and those finished, by all instances
+runProgressStatement="""select count(*) as total, coalesce(sum(case when state in ('done','failed','skipped') then 1 else 0 end),0) as finished,
+                        coalesce(sum(case when state='failed' then 1 else 0 end),0) as failed
+                        from collectwork where runid=?"""
+# state of a run, elapsed seconds up to now or its last update if finished
+runStatusStatement="""select state, timestampdiff(2, char((case when state='running' then current timestamp else updated end) - started)) as elapsed
+                      from collectruns where runid=?"""
+openWorkStatement="select count(*) from collectwork where runid=? and state in ('pending','leased')"
+# state of the repositories of each tenant, from the entry they were part of
+runSummaryStatement="""select tr.tid, tr.rid, w.state from collectwork w, repos wr, repos r, tenantrepos tr
+                       where w.runid=? and w.rid=wr.rid and r.oid=wr.oid and r.rname=wr.rname and tr.rid=r.rid
+                       order by tr.tid, tr.rid"""
+
+# merge the view and clone traffic data for one repository and day
+# Counts are only updated if the new value is higher. A NULL count means
+# that there is no data of that traffic type and the row is left alone.
+mergeTraffic="""merge into repotraffic rt
+            using (values(cast(? as int),cast(? as date),cast(? as int),cast(? as int),cast(? as int),cast(? as int)))
+            as nt(rid,tdate,viewcount,vuniques,clonecount,cuniques) on rt.rid=nt.rid and rt.tdate=nt.tdate
+            when matched and (nt.viewcount>rt.viewcount or nt.clonecount>rt.clonecount) then update set
+                viewcount=case when nt.viewcount>rt.viewcount then nt.viewcount else rt.viewcount end,
+                vuniques=case when nt.viewcount>rt.viewcount then coalesce(nt.vuniques,0) else rt.vuniques end,
+                clonecount=case when nt.clonecount>rt.clonecount then nt.clonecount else rt.clonecount end,
+                cuniques=case when nt.clonecount>rt.clonecount then coalesce(nt.cuniques,0) else rt.cuniques end
+            when not matched then insert (rid,tdate,viewcount,vuniques,clonecount,cuniques)
+                values(nt.rid,nt.tdate,coalesce(nt.viewcount,0),coalesce(nt.vuniques,0),coalesce(nt.clonecount,0),coalesce(nt.cuniques,0))
             else ignore"""
 
-# merge the clone traffic data
-mergeClones1="merge into repotraffic rt using (values"
-mergeClones2=""") as nc(rid,clonedate,clonecount,uniques) on rt.rid=nc.rid and rt.tdate=nc.clonedate
-             when matched and nc.clonecount>rt.clonecount then update set clonecount=nc.clonecount, cuniques=coalesce(nc.uniques,0)
-             when not matched then insert (rid,tdate,clonecount,cuniques) values(nc.rid,nc.clonedate,coalesce(nc.clonecount,0),coalesce(nc.uniques,0))
-             else ignore"""
+# store the last fetched traffic window of a repository
+mergeWindow="""merge into repowindow rw
+            using (values(cast(? as int),cast(? as char(40)),cast(? as varchar(4000)),cast(? as varchar(255)),cast(? as varchar(255))))
+            as nw(rid,digest,days,viewetag,cloneetag) on rw.rid=nw.rid
+            when matched then update set digest=nw.digest, days=nw.days, viewetag=nw.viewetag, cloneetag=nw.cloneetag
+            when not matched then insert (rid,digest,days,viewetag,cloneetag)
+                values(nw.rid,nw.digest,nw.days,nw.viewetag,nw.cloneetag)"""
 
 # new syslog record
 insertLogEntry="insert into systemlog values(?,?,?,?)"
 
-# Merge view data into the traffic table
-def mergeViewData(viewStats, rid, conn):
-    # convert traffic data into SQL values
-    data=""
-    for vday in viewStats['views']:
-        data+="("+str(rid)+",'"+vday['timestamp'][:10]+"',"+str(vday['count'])+","+str(vday['uniques'])+"),"
-    mergeStatement=mergeViews1+data[:-1]+mergeViews2
-    conn.execute(mergeStatement)
-
-
-# Merge clone data into the traffic table
-def mergeCloneData(cloneStats, rid, conn):
-    # convert traffic data into SQL values
-    data=""
-    for cday in cloneStats['clones']:
-        data+="("+str(rid)+",'"+cday['timestamp'][:10]+"',"+str(cday['count'])+","+str(cday['uniques'])+"),"
-    mergeStatement=mergeClones1+data[:-1]+mergeClones2
-    # execute MERGE statement
-    conn.execute(mergeStatement)
+# Write the buffered traffic rows using batched, parameterized MERGEs
+# and empty the buffer. Returns the number of rows written.
+def flushTraffic(buffer, conn):
+    rows=[(rid, day)+tuple(values) for (rid, day), values in buffer.items()]
+    for start in range(0, len(rows), MERGE_BATCH_SIZE):
+        started=time.perf_counter()
+        conn.execute(mergeTraffic, rows[start:start+MERGE_BATCH_SIZE])
+        observeMetric('ghstats_merge_seconds', time.perf_counter()-started)
+    incMetric('ghstats_merge_rows_total', len(rows))
+    if rows:
+        updateRollups(rows, conn)
+    buffer.clear()
+    return len(rows)
 
 
 # Overall flow:
-# - loop over users
-#   - log in to GitHub as that current user
-#   - retrieve repos for that current user, loop the repos
-#     - for each repo fetch stats
-#     - merge traffic data into table
-#  update last run info
-def github_traffic(username, access_token, org, repo, traffic_type):
-    url = f"https://api.github.com/repos/{org}/{repo}/traffic/{traffic_type}"
-    headers = { "Accept" : "application/vnd.github.v3+json"}
-    response = requests.get(url, headers=headers, auth=requests.auth.HTTPBasicAuth(username,access_token))
-    return response.json()
-
-
-
-def collectStatistics(logPrefix="collectStats"):
+# - join the running collection run or start a new one with all repos
+#   of all users as work
+# - lease a batch of repos, loop the repos by user
+#   - log in to GitHub as that user and fetch stats
+# - merge traffic data into table, mark the batch as done
+# - when no work is left, update last run info
+
+# GitHub client
+# Sessions are kept per tenant token, so that all requests of a collection
+# run (and of later runs in the same process) reuse pooled keep-alive
+# connections instead of doing a new TCP and TLS handshake each time.
+githubSessions={}
+githubSessionsLock=threading.Lock()
+
+def getGitHubSession(username, access_token):
+    key=(username, access_token)
+    with githubSessionsLock:
+        session=githubSessions.get(key)
+        if session is None:
+            session=requests.Session()
+            session.auth=requests.auth.HTTPBasicAuth(username,access_token)
+            session.headers.update({"Accept" : "application/vnd.github.v3+json"})
+            # the pool must be able to serve all collection workers at once
+            adapter=HTTPAdapter(pool_connections=1, pool_maxsize=max(GITHUB_POOL_SIZE, COLLECT_WORKERS))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            githubSessions[key]=session
+    return session
+
+# Raised when a token has no budget left and waiting for it is not worth it,
+# or when GitHub still rate limits the request after all retries
+class GitHubRateLimitError(Exception):
+    pass
+
+# Rate limit budget per token as reported by GitHub in the response headers.
+# All workers of a tenant share the budget, so that they do not overrun it.
+githubBudgets={}
+githubBudgetsLock=threading.Lock()
+
+def getGitHubBudget(access_token):
+    with githubBudgetsLock:
+        budget=githubBudgets.get(access_token)
+        if budget is None:
+            budget={'remaining': None, 'reset': 0, 'notBefore': 0, 'nextSlot': 0}
+            githubBudgets[access_token]=budget
+    return budget
+
+# Wait until the budget allows for another request and reserve it
+def reserveGitHubRequest(budget):
+    with githubBudgetsLock:
+        now=time.time()
+        if budget['reset']<=now:
+            # new window, the next response tells about the budget
+            budget['remaining']=None
+        start=max(now, budget['notBefore'], budget['nextSlot'])
+        if budget['remaining'] is not None:
+            available=budget['remaining']-GITHUB_RATELIMIT_RESERVE
+            if available<=0:
+                start=max(start, budget['reset'])
+            else:
+                if available<GITHUB_RATELIMIT_PACE_BELOW:
+                    # running low, spread the rest until the reset
+                    budget['nextSlot']=start+(budget['reset']-start)/available
+                budget['remaining']=budget['remaining']-1
+        if start-now>GITHUB_RATELIMIT_MAX_WAIT:
+            raise GitHubRateLimitError("GitHub rate limit exhausted until "+time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(start)))
+    if start>now:
+        time.sleep(start-now)
+
+# Take over the budget reported by GitHub
+def updateGitHubBudget(budget, response):
+    remaining=response.headers.get("X-RateLimit-Remaining")
+    reset=response.headers.get("X-RateLimit-Reset")
+    if remaining is not None and reset is not None:
+        with githubBudgetsLock:
+            budget['remaining']=int(remaining)
+            budget['reset']=int(reset)
+
+# Perform a GET request against the GitHub API using the tenant session.
+# Requests are paced according to the token budget. On hitting a rate limit
+# the request is retried after the advertised or an exponential back-off,
+# GitHubRateLimitError is raised once the retries are used up.
+def github_get(username, access_token, path, params=None, headers=None):
+    session=getGitHubSession(username, access_token)
+    budget=getGitHubBudget(access_token)
+    attempt=0
+    while True:
+        reserveGitHubRequest(budget)
+        started=time.perf_counter()
+        try:
+            response=session.get(GITHUB_API_URL+path, params=params, headers=headers,
+                                 timeout=(GITHUB_CONNECT_TIMEOUT, GITHUB_READ_TIMEOUT))
+        except:
+            observeMetric('ghstats_github_request_seconds', time.perf_counter()-started, status='error')
+            raise
+        observeMetric('ghstats_github_request_seconds', time.perf_counter()-started, status=str(response.status_code))
+        updateGitHubBudget(budget, response)
+        if response.status_code not in (403, 429):
+            return response
+        if 'Retry-After' in response.headers:
+            delay=int(response.headers['Retry-After'])
+        elif response.headers.get("X-RateLimit-Remaining")=="0":
+            # primary rate limit, reserveGitHubRequest waits for the reset
+            delay=0
+        elif 'secondary rate limit' in response.text.lower():
+            delay=60*(2**attempt)
+        else:
+            # regular permission problem, nothing to retry
+            return response
+        if attempt>=GITHUB_MAX_RETRIES:
+            raise GitHubRateLimitError("GitHub rate limit still hit after "+str(attempt)+" retries")
+        with githubBudgetsLock:
+            budget['notBefore']=max(budget['notBefore'], time.time()+delay)
+        attempt=attempt+1
+
+# Fetch view or clone traffic, conditionally if the ETag of the previous
+# response is given. Returns the stats, None if not modified, and the ETag.
+# Not modified responses do not count against the rate limit.
+def github_traffic(username, access_token, org, repo, traffic_type, etag=None):
+    headers={"If-None-Match": etag} if etag else None
+    response = github_get(username, access_token, f"/repos/{org}/{repo}/traffic/{traffic_type}", headers=headers)
+    if response.status_code==304:
+        incMetric('ghstats_github_not_modified_total')
+        return None, etag
+    response.raise_for_status()
+    return response.json(), response.headers.get("ETag")
+
+
+
+# Fetch view and clone traffic for a list of repositories, conditionally
+# with their stored ETags. Yields (repo, views, clones, error) in the order
+# of the repos, views and clones as returned by github_traffic.
+# With an executor all requests are submitted up front and run in the
+# worker threads, otherwise they are performed one by one. The database
+# is never touched here, so all merges stay with the caller.
+def fetchTraffic(username, access_token, repos, executor=None):
+    if executor is None:
+        for repo in repos:
+            try:
+                viewStats=github_traffic(username,access_token, org=repo["username"], repo=repo["rname"],traffic_type="views",etag=repo["viewetag"])
+                cloneStats=github_traffic(username,access_token, org=repo["username"], repo=repo["rname"],traffic_type="clones",etag=repo["cloneetag"])
+                yield repo, viewStats, cloneStats, None
+            except Exception as e:
+                yield repo, None, None, e
+        return
+    futures=[]
+    for repo in repos:
+        futures.append((repo,
+                        executor.submit(github_traffic, username, access_token, org=repo["username"], repo=repo["rname"], traffic_type="views", etag=repo["viewetag"]),
+                        executor.submit(github_traffic, username, access_token, org=repo["username"], repo=repo["rname"], traffic_type="clones", etag=repo["cloneetag"])))
+    for repo, viewFuture, cloneFuture in futures:
+        try:
+            yield repo, viewFuture.result(), cloneFuture.result(), None
+        except Exception as e:
+            yield repo, None, None, e
+
+# Retry a fetch denied with 403 or 404 using the credentials of the other
+# tenants tracking the repository, as the leasing tenant might have lost
+# access while others still have it. Returns views, clones and error of
+# the last attempt.
+def fetchTrafficFallback(repo, error):
+    for tid, ghuser, ghtoken in repo['fallbacks']:
+        if getattr(getattr(error, 'response', None), 'status_code', None) not in (403, 404):
+            break
+        _, viewStats, cloneStats, error=next(fetchTraffic(ghuser, ghtoken, [repo]))
+        if error is None:
+            return viewStats, cloneStats, None
+    return None, None, error
+
+
+# Identifies this instance as owner of leases
+collectWorkerId=socket.gethostname()[:60]+"-"+str(os.getpid())+"-"+uuid.uuid4().hex[:8]
+
+# Join the running collection run or, unless only joining, register a new
+# one with all repositories of all tenants as its work. Runs without recent
+# progress are abandoned. Returns the run id or None, and whether the run
+# was newly registered.
+def startCollectRun(join=False):
+    with dbTransaction() as connection:
+        # only one instance at a time may start a run
+        connection.execute(lockRunsStatement)
+        connection.execute(abandonRunsStatement, COLLECT_RESUME_HOURS)
+        runid=connection.execute(lastRunStatement).scalar()
+        created=False
+        if runid is None and not join:
+            created=True
+            runid=connection.execute(newRunStatement).scalar()
+            connection.execute(clearWorkStatement, runid)
+            connection.execute(updateScheduleStatement, COLLECT_HOT_ACTIVITY, COLLECT_ACTIVITY_DAYS)
+            connection.execute(enqueueWorkStatement, runid, COLLECT_MAX_HOURS, scheduleHours(COLLECT_WARM_HOURS), scheduleHours(COLLECT_COLD_HOURS))
+            connection.execute(backoffStatement)
+    return runid, created
+
+# Hours between collections of a tier, within the hard deadline
+def scheduleHours(hours):
+    return min(max(hours, 0), COLLECT_MAX_HOURS)
+
+# Lease the next batch of repositories of the run. Returns None if there
+# is no work left to lease, otherwise a list of the leased entries as dict
+# with tenant, GitHub repository and as "targets" the repository records
+# (with their stored traffic window) sharing it. The credentials of other
+# tenants tracking the repository are passed as "fallbacks".
+def claimCollectWork(runid):
+    with dbTransaction() as connection:
+        exhausted=connection.execute(failExhaustedWorkStatement, runid, COLLECT_MAX_ATTEMPTS).fetchall()
+        if exhausted:
+            app.logger.warning("Collection run "+str(runid)+": "+str(len(exhausted))+" repositories failed after "+str(COLLECT_MAX_ATTEMPTS)+" attempts")
+            connection.execute(recordFailureStatement, [(row['rid'], None, "Lease expired after "+str(COLLECT_MAX_ATTEMPTS)+" attempts",
+                                                         COLLECT_BACKOFF_MAX_RUNS, COLLECT_QUARANTINE_AFTER) for row in exhausted])
+        if connection.execute(claimWorkStatement, runid, COLLECT_COMMIT_EVERY, collectWorkerId, COLLECT_LEASE_SECONDS).rowcount==0:
+            return None
+        connection.execute(skipIdleWorkStatement, runid, collectWorkerId)
+        rows=connection.execute(claimedWorkStatement, runid, collectWorkerId).fetchall()
+        fallbacks={}
+        for row in connection.execute(fallbackTenantsStatement, runid, collectWorkerId):
+            fallbacks.setdefault(row['workrid'], []).append((row['tid'], row['ghuser'], row['ghtoken']))
+    work=[]
+    for (tid, workrid), targets in itertools.groupby(rows, key=lambda row: (row['tid'], row['workrid'])):
+        targets=list(targets)
+        entry={'tid': tid, 'rid': workrid, 'ghuser': targets[0]['ghuser'], 'ghtoken': targets[0]['ghtoken'],
+               'username': targets[0]['username'], 'rname': targets[0]['rname'], 'failures': targets[0]['failures'],
+               'targets': targets, 'fallbacks': fallbacks.get(workrid, [])}
+        # conditional requests only if all records have seen the same response
+        for etag in ('viewetag', 'cloneetag'):
+            etags=set(target[etag] for target in targets)
+            entry[etag]=etags.pop() if len(etags)==1 else None
+        work.append(entry)
+    return work
+
+# Take over the progress of the run, including that of other instances
+def updateCollectProgress(runid, progress):
+    row=db.engine.execute(runProgressStatement, runid).fetchone()
+    progress['reposTotal']=row['total']
+    progress['reposDone']=row['finished']
+
+# Extend the leases of this instance. Returns the number of leases held.
+def renewCollectLeases(conn, runid):
+    return conn.execute(renewLeaseStatement, COLLECT_LEASE_SECONDS, runid, collectWorkerId).rowcount
+
+# Keep renewing the leases of this instance in a background thread while
+# a batch is in flight, so that they do not expire while requests to
+# GitHub wait for a rate limit reset or back-off.
+@contextmanager
+def leaseHeartbeat(runid):
+    stop=threading.Event()
+    def heartbeat():
+        while not stop.wait(COLLECT_LEASE_SECONDS/3):
+            try:
+                with app.app_context():
+                    with dbTransaction() as connection:
+                        renewCollectLeases(connection, runid)
+            except Exception:
+                app.logger.exception("Cannot renew the collection leases")
+    thread=threading.Thread(target=heartbeat, name="collect-lease-"+str(runid), daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+# Finish the run if no work is left. Only one instance succeeds and writes
+# the log entries for all tenants. Returns whether the run was finished.
+def finishCollectRun(runid, logPrefix):
+    with dbTransaction() as connection:
+        if connection.execute(openWorkStatement, runid).scalar()>0:
+            return False
+        if connection.execute(finishRunStatement, 'completed', runid).rowcount!=1:
+            return False
+        ts=time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        for tid, rows in itertools.groupby(connection.execute(runSummaryStatement, runid), key=lambda row: row['tid']):
+            states={}
+            for row in rows:
+                states.setdefault(row['state'], []).append(row['rid'])
+            done=len(states.get('done', []))
+            logtext=logPrefix+" ("+str(done)+"/"+str(sum(len(rids) for rids in states.values()))+")"
+            if 'failed' in states:
+                logtext=logtext+", repo errors: "+" ".join(str(rid) for rid in states['failed'])+" "
+            if 'skipped' in states:
+                logtext=logtext+", skipped: "+str(len(states['skipped']))
+            connection.execute(insertLogEntry,(tid,ts,done,logtext))
+    return True
+
+
+# Collect the traffic of the current run. Repositories are leased in
+# batches from the work queue, fetched (possibly in parallel) and merged,
+# then marked done together with the merge. Other app instances can work
+# on the same run at the same time. With join=True, only a running run is
+# joined. The progress dict, if passed, is updated with the number of
+# repositories in the run, those processed (by all instances) and the
+# failures of this instance while the run is going on. Returns the number
+# of repositories processed and whether this instance completed the run.
+# A run already registered with startCollectRun is passed as runid.
+def collectStatistics(logPrefix="collectStats", progress=None, join=False, runid=None):
     repoCount=0
-    processedRepos=0
-    logtext=logPrefix+" ("
-    errortext=""
-    connection = db.engine.connect()
-    trans = connection.begin()
+    completed=False
+    # pending traffic rows, merged in batches
+    trafficBuffer={}
+    if progress is None:
+        progress={}
+    progress.update({'reposTotal': 0, 'reposDone': 0, 'errors': 0})
+    started=time.perf_counter()
+    if runid is None:
+        runid, created=startCollectRun(join)
+    if runid is None:
+        return {"repoCount": 0, "completed": False}
+    executor=None
+    if COLLECT_WORKERS>1:
+        executor=ThreadPoolExecutor(max_workers=COLLECT_WORKERS, thread_name_prefix="ghfetch")
     try:
-        # go over all system users
-        allTenants=connection.execute(allTenantsStatement)
-        for row in allTenants:
-
-            # prepare statement for logging
-            #logStmt = ibm_db.prepare(conn, insertLogEntry)
-        
-            # go over all repos managed by that user and fetch traffic data
-            # first, login to GitHub as that user
-            tid=row["tid"]
-            username=row["ghuser"]
-            access_token=row["ghtoken"]
-
-            userRepoCount=0
-            # prepare and execute statement to fetch related repositories
-            repos=connection.execute(allReposStatement,tid)
-            for row in repos:
-                repoCount=repoCount+1
-                # fetch view and clone traffic
-                try:
-                    viewStats=github_traffic(username,access_token, org=row["username"], repo=row["rname"],traffic_type="views")
-                    cloneStats=github_traffic(username,access_token, org=row["username"], repo=row["rname"],traffic_type="clones")
-                    if viewStats['views']:
-                        mergeViewData(viewStats,row["rid"], connection)
-                    if cloneStats['clones']:
-                        mergeCloneData(cloneStats,row["rid"], connection)
-                    userRepoCount=userRepoCount+1
-                    # For debugging:
-                    # print repo["USERNAME"]+" "+ repo["RNAME"]
-
-                    # update global repo counter
-                    processedRepos=processedRepos+1
-                    # fetch next repository
-                except:
-                    errortext=errortext+str(row["rid"])+" "
-                
-            # insert log entry
-            ts = time.gmtime()
-            logtext=logtext+str(processedRepos)+"/"+str(repoCount)+")"
-            if errortext !="":
-                logtext=logtext+", repo errors: "+errortext
-            connection.execute(insertLogEntry,(tid,time.strftime("%Y-%m-%d %H:%M:%S", ts),userRepoCount,logtext))
-        trans.commit()
+        while True:
+            updateCollectProgress(runid, progress)
+            work=claimCollectWork(runid)
+            if work is None:
+                break
+            results=[]
+            # failures to record and repositories working again
+            failures=[]
+            recovered=[]
+            # new traffic windows, by repository as it might be shared
+            windows={}
+            collected=[]
+            with leaseHeartbeat(runid):
+                # go over the leased repositories by tenant, fetching with the
+                # tenant credentials
+                for tid, repos in itertools.groupby(work, key=lambda row: row['tid']):
+                    repos=list(repos)
+                    # traffic is fetched (possibly in parallel), but buffered here
+                    # and merged in batches using a single connection
+                    for repo, viewStats, cloneStats, error in fetchTraffic(repos[0]['ghuser'], repos[0]['ghtoken'], repos, executor):
+                        repoCount=repoCount+1
+                        try:
+                            if error is not None:
+                                viewStats, cloneStats, error=fetchTrafficFallback(repo, error)
+                            if error is not None:
+                                raise error
+                            for target in repo['targets']:
+                                unchanged=diffTraffic(trafficBuffer, windows, target, viewStats, cloneStats)
+                                incMetric('ghstats_merge_rows_unchanged_total', unchanged)
+                                collected.append((runid, target['rid']))
+                            results.append(('done', runid, tid, repo["rid"], collectWorkerId))
+                            if repo['failures']:
+                                recovered.append((repo["rid"],))
+                            incMetric('ghstats_collection_repos_total', result='processed')
+                        except GitHubRateLimitError:
+                            # rate limited, not a problem of the repository,
+                            # try again next run
+                            results.append(('skipped', runid, tid, repo["rid"], collectWorkerId))
+                            progress['errors']=progress['errors']+1
+                            incMetric('ghstats_collection_repos_total', result='ratelimited')
+                        except Exception as e:
+                            results.append(('failed', runid, tid, repo["rid"], collectWorkerId))
+                            status=getattr(getattr(e, 'response', None), 'status_code', None)
+                            failures.append((repo["rid"], status, str(e)[:255], COLLECT_BACKOFF_MAX_RUNS, COLLECT_QUARANTINE_AFTER))
+                            progress['errors']=progress['errors']+1
+                            incMetric('ghstats_collection_repos_total', result='failed')
+                        progress['reposDone']=progress['reposDone']+1
+
+            # merge and mark the work as done in one transaction
+            with dbTransaction() as connection:
+                # entries without anything to collect were skipped when
+                # claiming, so all leases held belong to the work
+                if renewCollectLeases(connection, runid)<len(work):
+                    # leases were lost and possibly taken over, leave the
+                    # batch to others instead of processing it twice
+                    app.logger.warning("Collection run "+str(runid)+": leases expired, batch dropped")
+                    trafficBuffer.clear()
+                    connection.execute(releaseWorkStatement, runid, collectWorkerId)
+                    continue
+                flushTraffic(trafficBuffer, connection)
+                if windows:
+                    connection.execute(mergeWindow, list(windows.values()))
+                if collected:
+                    connection.execute(markCollectedStatement, collected)
+                if results:
+                    connection.execute(completeWorkStatement, results)
+                if failures:
+                    connection.execute(recordFailureStatement, failures)
+                if recovered:
+                    connection.execute(clearFailureStatement, recovered)
+                connection.execute(touchRunStatement, runid)
+        updateCollectProgress(runid, progress)
+        completed=finishCollectRun(runid, logPrefix)
+        if completed:
+            bumpDataVersion()
+            observeMetric('ghstats_collection_seconds', time.perf_counter()-started)
+            setMetric('ghstats_collection_last_success_timestamp', time.time())
     except:
-        trans.rollback()
+        # hand back the leased work to other instances or the next run
+        trafficBuffer.clear()
+        try:
+            with dbTransaction() as connection:
+                connection.execute(releaseWorkStatement, runid, collectWorkerId)
+        except Exception:
+            app.logger.exception("Cannot release the collection leases")
         raise
-    return {"repoCount": repoCount}
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return {"repoCount": repoCount, "completed": completed}
+
+# Collection jobs
+# A collection run is performed in a background thread, so that the
+# triggering request returns right away. Only one job runs at a time in
+# this instance, the most recent jobs are kept by run id to report their
+# errors. The status of a run is read from the database, so that any
+# instance can report it.
+collectJobs=OrderedDict()
+collectJobsLock=threading.Lock()
+
+# Start a new collection job unless one is running already. The job works
+# on the running collection run or, unless join=True, registers a new one.
+# Returns the job (None if there is no run to join) and whether the run
+# was newly registered.
+def startCollectJob(logPrefix, join=False):
+    with collectJobsLock:
+        for job in collectJobs.values():
+            if job['state']=='running':
+                return job, False
+        runid, created=startCollectRun(join)
+        if runid is None:
+            return None, False
+        job={'runid': runid, 'state': 'running', 'logPrefix': logPrefix,
+             'message': None, 'reposTotal': 0, 'reposDone': 0, 'errors': 0}
+        collectJobs[runid]=job
+        while len(collectJobs)>COLLECT_JOBS_KEPT:
+            collectJobs.popitem(last=False)
+    threading.Thread(target=runCollectJob, args=(job,), name="collect-"+str(runid), daemon=True).start()
+    return job, created
+
+def runCollectJob(job):
+    try:
+        with app.app_context():
+            result=collectStatistics(logPrefix=job['logPrefix'], progress=job, runid=job['runid'])
+            # the instance completing the run takes care of the retention
+            if result['completed']:
+                applyRetention()
+        job['state']='completed'
+    except Exception as e:
+        app.logger.exception("Collection job for run "+str(job['runid'])+" failed")
+        job['state']='failed'
+        job['message']=str(e)
+    # purges are held back while collecting
+    startPurgeJob()
+
+# Status information about a collection run across all instances, suitable
+# for JSON. The error of a job of this instance is reported as message.
+# Returns None for an unknown run.
+def collectRunStatus(runid):
+    run=db.engine.execute(runStatusStatement, runid).fetchone()
+    if run is None:
+        return None
+    progress=db.engine.execute(runProgressStatement, runid).fetchone()
+    job=collectJobs.get(runid)
+    return {'runid': runid, 'state': run['state'],
+            'reposDone': progress['finished'], 'reposTotal': progress['total'],
+            'errors': progress['failed'], 'elapsed': run['elapsed'],
+            'message': job['message'] if job is not None else None}
+
+# Join running collection runs, e.g., started by another instance
+def pollCollectRuns():
+    while True:
+        time.sleep(COLLECT_POLL_INTERVAL)
+        try:
+            with app.app_context():
+                if db.engine.execute(lastRunStatement).scalar() is not None:
+                    startCollectJob(logPrefix='joined', join=True)
+        except Exception:
+            app.logger.exception("Cannot check for collection runs")
+
+if ALL_CONFIGURED and COLLECT_POLL_INTERVAL>0:
+    threading.Thread(target=pollCollectRuns, name="collect-poll", daemon=True).start()
 
 @app.route('/admin/collectStats')
 @security_decorator_auth
 def collectStats():
-    res=collectStatistics(logPrefix='collectStats')
-    return render_template('collect.html',repoCount=res["repoCount"])
+    job, started=startCollectJob(logPrefix='collectStats')
+    return render_template('collect.html',job=collectRunStatus(job['runid']), started=started)
+
+# Report the status of a collection run
+@app.route('/admin/collectStats/<int:runid>')
+@security_decorator_auth
+def collectStatsStatus(runid):
+    if isSysMaintainer() or isAdministrator():
+        status=collectRunStatus(runid)
+        if status is None:
+            return jsonify(message="Error: unknown run"),404
+        return jsonify(status)
+    else:
+        return jsonify(message="You are not authorized."),403
 
 # Ping subscription in Code Engine
 # Check for secret token
@@ -783,38 +2129,173 @@ def collectStats():
 def eventCollectStats():
     mydata=request.json
     if mydata['token']==EVENT_TOKEN:
-        res=collectStatistics(logPrefix='CEping')
-        return jsonify(message="success - stats collected", repoCount=res["repoCount"]),200
+        job, started=startCollectJob(logPrefix='CEping')
+        if started:
+            return jsonify(message="success - collection started", runid=job['runid']),202
+        else:
+            return jsonify(message="collection already running", runid=job['runid']),409
     else:
         return "no success",403
 
 
-# return the repository statistics for the web page, dynamically loaded
+# Retention
+# Daily rows are already part of the weekly and monthly rollups, old days
+# (and old weeks) can be removed without losing the totals.
+retentionChunkStatement="delete from (select * from {table} where {date}<? fetch first ? rows only)"
+
+# Remove data older than the retention cutoffs, each chunk in its own
+# transaction. Returns the number of rows removed.
+def applyRetention():
+    daily, weekly=retentionCutoffs(max(RETAIN_DAILY_DAYS, RETAIN_DAILY_MIN) if RETAIN_DAILY_DAYS>0 else 0, RETAIN_WEEKLY_DAYS)
+    removed=0
+    for table, datecol, cutoff in (('repotraffic', 'tdate', daily), ('repotrafficweekly', 'weekstart', weekly)):
+        if cutoff is None:
+            continue
+        stmt=retentionChunkStatement.format(table=table, date=datecol)
+        while True:
+            with dbTransaction() as connection:
+                deleted=connection.execute(stmt, cutoff, PURGE_BATCH_SIZE).rowcount
+            incMetric('ghstats_retention_rows_total', deleted, table=table)
+            removed=removed+deleted
+            if deleted<PURGE_BATCH_SIZE:
+                break
+            time.sleep(PURGE_PAUSE)
+    if removed>0:
+        bumpDataVersion()
+        print("Retention removed "+str(removed)+" rows")
+    return removed
+
+
+# Purge of deleted repositories
+# The traffic rows of a deleted repository are removed in chunks, each in
+# its own short transaction, so that neither the dashboard queries nor the
+# collection have to wait for the locks for long. Deleted repositories are
+# recorded in the database, so an interrupted purge continues with the next
+# job. Purges do not run during a collection of this instance, the job is
+# started again once the collection is done.
+purgeState={'running': False}
+purgeLock=threading.Lock()
+
+# next repository to purge. Repositories deleted after a running collection
+# run started might still be leased by any instance and merged into, they
+# are held back until the run is over.
+nextPurgeStatement="""select rid from repos where deleted is not null
+                      and deleted<coalesce((select min(started) from collectruns where state='running'), current timestamp)
+                      order by deleted, rid fetch first 1 row only"""
+# last day of the next chunk of traffic rows
+purgeChunkEndStatement="select max(tdate) from (select tdate from repotraffic where rid=? order by tdate fetch first ? rows only) t"
+archiveTrafficStatement="""insert into repotrafficarchive (rid,orgname,reponame,tdate,viewcount,vuniques,clonecount,cuniques)
+                           select rt.rid, gu.username, r.rname, rt.tdate, rt.viewcount, rt.vuniques, rt.clonecount, rt.cuniques
+                           from repotraffic rt, repos r, ghorgusers gu
+                           where rt.rid=r.rid and r.oid=gu.oid and rt.rid=? and rt.tdate<=?"""
+purgeTrafficStatement="delete from repotraffic where rid=? and tdate<=?"
+
+# Start the purge in a background thread unless it or a collection is
+# running already. Returns whether it was started.
+def startPurgeJob():
+    with collectJobsLock:
+        for job in collectJobs.values():
+            if job['state']=='running':
+                return False
+    with purgeLock:
+        if purgeState['running']:
+            return False
+        purgeState['running']=True
+    threading.Thread(target=runPurgeJob, name="purge", daemon=True).start()
+    return True
+
+def runPurgeJob():
+    try:
+        with app.app_context():
+            purgeDeletedRepos()
+    except Exception:
+        app.logger.exception("Purge of deleted repositories failed")
+    finally:
+        with purgeLock:
+            purgeState['running']=False
+
+# Purge all repositories marked as deleted
+def purgeDeletedRepos():
+    while True:
+        rid=db.engine.execute(nextPurgeStatement).scalar()
+        if rid is None:
+            return
+        purgeRepo(rid)
+
+# Remove the traffic data of a deleted repository chunk by chunk (archived
+# first if configured), then its rollups and the repository record
+def purgeRepo(rid):
+    while True:
+        with dbTransaction() as connection:
+            last=connection.execute(purgeChunkEndStatement, rid, PURGE_BATCH_SIZE).scalar()
+            if last is None:
+                connection.execute("delete from repotrafficweekly where rid=?",rid)
+                connection.execute("delete from repotrafficmonthly where rid=?",rid)
+                connection.execute("delete from repowindow where rid=?",rid)
+                connection.execute("delete from repofailures where rid=?",rid)
+                connection.execute("delete from repos where rid=?",rid)
+                break
+            if PURGE_ARCHIVE:
+                connection.execute(archiveTrafficStatement, rid, last)
+            purged=connection.execute(purgeTrafficStatement, rid, last).rowcount
+        incMetric('ghstats_purge_rows_total', purged)
+        time.sleep(PURGE_PAUSE)
+    incMetric('ghstats_purge_repos_total')
+    print("Purged repo with id "+str(rid))
+
+
+# Chart data
+# Metrics and granularities offered for the chart, mapped to the columns
+# and the tables (with their date column) to read from
+chartMetrics={'views': 'viewcount', 'uniques': 'vuniques', 'clones': 'clonecount', 'cuniques': 'cuniques'}
+chartSources={'day': ('repotraffic', 'tdate'), 'week': ('repotrafficweekly', 'weekstart'), 'month': ('repotrafficmonthly', 'monthstart')}
+
+chartStmt="""select r.rid, r.{date} as x, r.{metric} as y
+             from {table} r, useraccess v
+             where r.rid=v.rid
+             and v.email=?
+             and r.{date} between ? and ?
+             order by r.rid, r.{date} asc"""
+
+chartRepoStmt="""select r.rid, r.rname from repos r, useraccess v
+                 where r.rid=v.rid
+                 and v.email=?
+                 order by rid asc"""
+
+# return the chart data for the repositories, dynamically loaded
+# Parameters (all optional):
+# - from, to: date range as YYYY-MM-DD, the past month by default
+# - metric: views, uniques, clones or cuniques, views by default
+# - granularity: day, week or month, day by default
+# - points: maximum number of points per repository, longer series are
+#   downsampled, CHART_MAX_POINTS by default
 @app.route('/data/repostats.json')
 @security_decorator_auth
+@cached_data
 def generate_data_repostats_json():
-    values=[]
     datasets=[]
     if isTenant() or isTenantViewer() or isRepoViewer():
-        fetchStmt="""select r.rid, r.tdate, r.viewcount
-                     from repotraffic r, v_adminuserrepos v
-                     where r.rid=v.rid
-                     and v.email=?
-                     and r.tdate between (current date - 1 month) and (current date)
-                     order by r.rid, r.tdate asc"""
-
-        repoStmt="""select r.rid, r.rname from repos r, v_adminuserrepos v
-                    where r.rid=v.rid
-                    and v.email=?
-                    order by rid asc"""
-        result = db.engine.execute(fetchStmt,flask.session['id_token']['email'])
-        for row in result:
-            values.append({'x':row['tdate'].isoformat(),'y':row['viewcount'], 'id':row['rid']})
-
-        repos = db.engine.execute(repoStmt,flask.session['id_token']['email']).fetchall()
+        try:
+            today=datetime.date.today()
+            todate=datetime.date.fromisoformat(request.args.get('to', today.isoformat()))
+            fromdate=datetime.date.fromisoformat(request.args.get('from', (todate-datetime.timedelta(days=30)).isoformat()))
+            metric=chartMetrics[request.args.get('metric', 'views')]
+            table, datecol=chartSources[request.args.get('granularity', 'day')]
+            maxPoints=int(request.args.get('points', CHART_MAX_POINTS))
+        except (ValueError, KeyError):
+            return jsonify(message="Error: invalid parameters"),400
+
+        # group the points by repository in a single pass
+        series={}
+        result = dataQuery(chartStmt.format(table=table, date=datecol, metric=metric),
+                                   flask.session['id_token']['email'], fromdate, todate)
+        for rid, rows in itertools.groupby(result, key=lambda row: row['rid']):
+            series[rid]=lttb([(row['x'].toordinal(), row['y']) for row in rows], maxPoints)
+
+        repos = dataQuery(chartRepoStmt,flask.session['id_token']['email'], query='repos')
         for row in repos:
-            rdict=[d for d in values if d['id'] == row['rid']]
-            datasets.append({'data': rdict, 'label': row['rname']})
+            data=[{'x': datetime.date.fromordinal(x).isoformat(), 'y': y} for x, y in series.get(row['rid'], [])]
+            datasets.append({'data': data, 'label': row['rname']})
 
     return jsonify(labels=[], data=datasets)
 
@@ -0,0 +1,147 @@
+# Traffic data handling of the GitHub traffic statistics app, kept free of
+# Flask and the database connection so that it can be used (and tested) on
+# its own: change detection of the fetched traffic windows, the rollups,
+# the retention cutoffs and the downsampling of the chart series.
+#
+# (C) 2018-2022 by IBM
+
+import datetime, json, hashlib
+
+
+# recompute the weekly and monthly rollups of a repository for a date range
+# The range has to cover full weeks or months.
+mergeWeeklyRollup="""merge into repotrafficweekly w
+            using (select rid, tdate - (dayofweek_iso(tdate)-1) days as weekstart,
+                   sum(viewcount) as viewcount, sum(vuniques) as vuniques, sum(clonecount) as clonecount, sum(cuniques) as cuniques
+                   from repotraffic where rid=cast(? as int) and tdate between cast(? as date) and cast(? as date)
+                   group by rid, tdate - (dayofweek_iso(tdate)-1) days) as n
+            on w.rid=n.rid and w.weekstart=n.weekstart
+            when matched then update set viewcount=n.viewcount, vuniques=n.vuniques, clonecount=n.clonecount, cuniques=n.cuniques
+            when not matched then insert (rid,weekstart,viewcount,vuniques,clonecount,cuniques)
+                values(n.rid,n.weekstart,n.viewcount,n.vuniques,n.clonecount,n.cuniques)"""
+
+mergeMonthlyRollup="""merge into repotrafficmonthly m
+            using (select rid, tdate - (day(tdate)-1) days as monthstart,
+                   sum(viewcount) as viewcount, sum(vuniques) as vuniques, sum(clonecount) as clonecount, sum(cuniques) as cuniques
+                   from repotraffic where rid=cast(? as int) and tdate between cast(? as date) and cast(? as date)
+                   group by rid, tdate - (day(tdate)-1) days) as n
+            on m.rid=n.rid and m.monthstart=n.monthstart
+            when matched then update set viewcount=n.viewcount, vuniques=n.vuniques, clonecount=n.clonecount, cuniques=n.cuniques
+            when not matched then insert (rid,monthstart,viewcount,vuniques,clonecount,cuniques)
+                values(n.rid,n.monthstart,n.viewcount,n.vuniques,n.clonecount,n.cuniques)"""
+
+# The traffic window returned by GitHub as dict of day and
+# [views, uniques, clones, uniques], a count is None if not reported.
+# Stats of None (not modified) are taken from the previous window.
+def trafficWindow(viewStats, cloneStats, previous):
+    window={}
+    for offset, traffic_type, stats in ((0, "views", viewStats), (2, "clones", cloneStats)):
+        if stats is None:
+            for day, values in previous.items():
+                if values[offset] is not None:
+                    window.setdefault(day, [None, None, None, None])[offset:offset+2]=values[offset:offset+2]
+            continue
+        for day in stats[traffic_type]:
+            values=window.setdefault(day['timestamp'][:10], [None, None, None, None])
+            values[offset]=day['count']
+            values[offset+1]=day['uniques']
+    return window
+
+# Add the days of the window which are new or have higher counts than in
+# the previous window to the buffer of pending rows. Other days would not
+# change anything in the MERGE. The buffer is keyed by (rid, day).
+# Returns the number of days buffered.
+def bufferChangedTraffic(buffer, rid, window, previous):
+    changed=0
+    for day, values in window.items():
+        old=previous.get(day)
+        if old is None or any(new is not None and (before is None or new>before)
+                              for new, before in ((values[0], old[0]), (values[2], old[2]))):
+            buffer[(rid, day)]=list(values)
+            changed=changed+1
+    return changed
+
+# Compare the fetched view and clone traffic, each as (stats, ETag) with
+# stats None if not modified, against the window stored for the repository
+# (or already fetched in this batch). The changed days are added to the
+# buffer, the new window with its ETags is put into windows (keyed by rid)
+# if anything changed. Returns the number of days left unchanged.
+def diffTraffic(buffer, windows, repo, viewResult, cloneResult):
+    rid=repo["rid"]
+    stored=windows.get(rid) or (rid, repo["digest"], repo["days"], repo["viewetag"], repo["cloneetag"])
+    (viewStats, viewEtag), (cloneStats, cloneEtag)=viewResult, cloneResult
+    if viewStats is None and cloneStats is None:
+        return 0
+    previous=json.loads(stored[2]) if stored[2] else {}
+    window=trafficWindow(viewStats, cloneStats, previous)
+    encoded=json.dumps(dict(sorted(window.items())), separators=(',', ':')).encode('utf-8')
+    digest=hashlib.sha1(encoded).hexdigest()
+    changed=0
+    if digest!=stored[1]:
+        changed=bufferChangedTraffic(buffer, rid, window, previous)
+    if digest!=stored[1] or (viewEtag, cloneEtag)!=tuple(stored[3:]):
+        windows[rid]=(rid, digest, encoded.decode('utf-8'), viewEtag, cloneEtag)
+    return len(window)-changed
+
+# Recompute the weekly and monthly rollups for the weeks and months
+# touched by the merged traffic rows
+def updateRollups(rows, conn):
+    ranges={}
+    for row in rows:
+        rid=row[0]
+        day=datetime.date.fromisoformat(row[1])
+        first, last=ranges.get(rid, (day, day))
+        ranges[rid]=(min(first, day), max(last, day))
+    weeks=[]
+    months=[]
+    for rid, (first, last) in ranges.items():
+        weeks.append((rid, first-datetime.timedelta(days=first.weekday()), last+datetime.timedelta(days=6-last.weekday())))
+        nextMonth=(last.replace(day=28)+datetime.timedelta(days=4)).replace(day=1)
+        months.append((rid, first.replace(day=1), nextMonth-datetime.timedelta(days=1)))
+    conn.execute(mergeWeeklyRollup, weeks)
+    conn.execute(mergeMonthlyRollup, months)
+
+# First day to keep for the daily and weekly data, given the days to keep
+# for each (0 keeps all), None to keep all.
+# The daily cutoff is moved back to the first day of a month which is a
+# Monday, so that no week or month loses only part of its days. Such a
+# month comes at least every 14 months.
+def retentionCutoffs(dailyDays, weeklyDays, today=None):
+    today=today or datetime.date.today()
+    daily=None
+    weekly=None
+    if dailyDays>0:
+        daily=(today-datetime.timedelta(days=dailyDays)).replace(day=1)
+        while daily.weekday()!=0:
+            daily=(daily-datetime.timedelta(days=1)).replace(day=1)
+    if weeklyDays>0:
+        weekly=today-datetime.timedelta(days=weeklyDays)
+    return daily, weekly
+
+# Downsample a series of (x, y) points to the given number of points using
+# the Largest-Triangle-Three-Buckets algorithm, which keeps the visual shape
+# including peaks. x has to be numeric.
+def lttb(points, threshold):
+    if threshold>=len(points) or threshold<3:
+        return points
+    sampled=[points[0]]
+    bucketSize=(len(points)-2)/(threshold-2)
+    a=0
+    for i in range(threshold-2):
+        # average of the next bucket as third point of the triangle
+        nextStart=int((i+1)*bucketSize)+1
+        nextEnd=min(int((i+2)*bucketSize)+1, len(points))
+        avgX=sum(p[0] for p in points[nextStart:nextEnd])/(nextEnd-nextStart)
+        avgY=sum(p[1] for p in points[nextStart:nextEnd])/(nextEnd-nextStart)
+        # pick the point of the current bucket with the largest triangle
+        ax, ay=points[a]
+        maxArea=-1
+        for j in range(int(i*bucketSize)+1, int((i+1)*bucketSize)+1):
+            area=abs((ax-avgX)*(points[j][1]-ay)-(ax-points[j][0])*(avgY-ay))
+            if area>maxArea:
+                maxArea=area
+                nextA=j
+        sampled.append(points[nextA])
+        a=nextA
+    sampled.append(points[-1])
+    return sampled
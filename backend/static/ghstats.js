@@ -26,6 +26,35 @@ function addRepo() {
   return false;
 }
 
+// Add many repositories at once, either listed or all of an organisation
+function addRepos() {
+  var xhttp;
+  var orgname = document.forms['newrepos'].elements['orgname'].value;
+  var repos = document.forms['newrepos'].elements['repos'].value;
+  xhttp = new XMLHttpRequest();
+  xhttp.onreadystatechange = function () {
+    if (xhttp.readyState == XMLHttpRequest.DONE) {
+      var response = JSON.parse(xhttp.responseText);
+      document.getElementById("messageResult").style.display = "block";
+      document.getElementById("plogmessage").innerHTML = "Message: " + response.message;
+      if (response.added) {
+        t=$('#repolist').DataTable();
+        response.added.forEach(function (repo) {
+          t.row.add([repo.repoid, repo.orgname, repo.reponame ]).node().id=repo.repoid;
+        });
+        t.draw();
+      }
+      document.getElementById("bulkorgname").value = '';
+      document.getElementById("bulkrepos").value = '';
+    }
+  };
+  xhttp.open('POST', "/api/newrepos");
+  xhttp.setRequestHeader("Content-type", "application/x-www-form-urlencoded");
+  var postVars = 'orgname=' + encodeURIComponent(orgname) + '&repos=' + encodeURIComponent(repos);
+  xhttp.send(postVars);
+  return false;
+}
+
 // Delete an existing repository by ID
 function deleteRepo() {
   var xhttp;
@@ -47,3 +76,25 @@ function deleteRepo() {
   xhttp.send(postVars);
   return false;
 }
+
+// Release a repository failing to be collected by ID
+function releaseRepo() {
+  var xhttp;
+  var repoid = document.forms['releaserepo'].elements['repoid'].value;
+  xhttp = new XMLHttpRequest();
+  xhttp.onreadystatechange = function () {
+    if (xhttp.readyState == XMLHttpRequest.DONE) {
+      var response = JSON.parse(xhttp.responseText);
+      document.getElementById("messageResult").style.display = "block";
+      document.getElementById("plogmessage").innerHTML = "Message: " + response.message;
+      // delete from shown HTML table and redraw
+      $('#repofailures').DataTable().row("#"+repoid).remove().draw();
+      document.getElementById("repoid").value = '';
+    }
+  };
+  xhttp.open('POST', "/api/releaserepo");
+  xhttp.setRequestHeader("Content-type", "application/x-www-form-urlencoded");
+  var postVars = 'repoid=' + repoid;
+  xhttp.send(postVars);
+  return false;
+}
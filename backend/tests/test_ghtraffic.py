@@ -0,0 +1,171 @@
+# Tests for the traffic data handling in ghtraffic.py, which needs neither
+# Flask nor the database:
+#
+#   cd backend && python -m pytest tests
+
+import datetime, json, os, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ghtraffic import (trafficWindow, bufferChangedTraffic, diffTraffic,
+                       updateRollups, retentionCutoffs, lttb)
+
+
+# GitHub traffic response for the given days as {day: (count, uniques)}
+def stats(traffic_type, days):
+    return {traffic_type: [{'timestamp': day+'T00:00:00Z', 'count': count, 'uniques': uniques}
+                           for day, (count, uniques) in sorted(days.items())]}
+
+# Repository as claimed for the collection, with its stored window
+def repo(rid=1000, window=None, viewetag=None, cloneetag=None):
+    if window is None:
+        return {'rid': rid, 'digest': None, 'days': None, 'viewetag': viewetag, 'cloneetag': cloneetag}
+    buffer={}
+    windows={}
+    diffTraffic(buffer, windows, {'rid': rid, 'digest': None, 'days': None, 'viewetag': None, 'cloneetag': None},
+                (stats('views', {day: tuple(v[0:2]) for day, v in window.items()}), viewetag),
+                (stats('clones', {day: tuple(v[2:4]) for day, v in window.items()}), cloneetag))
+    _, digest, days, _, _=windows[rid]
+    return {'rid': rid, 'digest': digest, 'days': days, 'viewetag': viewetag, 'cloneetag': cloneetag}
+
+
+class TrafficWindowTest(unittest.TestCase):
+
+    def testMergesViewsAndClones(self):
+        window=trafficWindow(stats('views', {'2024-06-01': (5, 2)}), stats('clones', {'2024-06-02': (1, 1)}), {})
+        self.assertEqual(window, {'2024-06-01': [5, 2, None, None], '2024-06-02': [None, None, 1, 1]})
+
+    def testNotModifiedTakesPrevious(self):
+        previous={'2024-06-01': [5, 2, 3, 1]}
+        window=trafficWindow(None, stats('clones', {'2024-06-01': (4, 2)}), previous)
+        self.assertEqual(window, {'2024-06-01': [5, 2, 4, 2]})
+
+
+class BufferChangedTrafficTest(unittest.TestCase):
+
+    def testOnlyNewOrIncreasedDays(self):
+        previous={'2024-06-01': [5, 2, 3, 1], '2024-06-02': [1, 1, 0, 0]}
+        window={'2024-06-01': [5, 2, 3, 1], '2024-06-02': [2, 1, 0, 0], '2024-06-03': [1, 1, 0, 0]}
+        buffer={}
+        self.assertEqual(bufferChangedTraffic(buffer, 7, window, previous), 2)
+        self.assertEqual(sorted(buffer), [(7, '2024-06-02'), (7, '2024-06-03')])
+
+    def testDecreasedCountNotBuffered(self):
+        buffer={}
+        changed=bufferChangedTraffic(buffer, 7, {'2024-06-01': [4, 2, 3, 1]}, {'2024-06-01': [5, 2, 3, 1]})
+        self.assertEqual(changed, 0)
+        self.assertEqual(buffer, {})
+
+
+class DiffTrafficTest(unittest.TestCase):
+
+    def testUnchangedWindowIsSkipped(self):
+        stored=repo(window={'2024-06-01': [5, 2, 3, 1]}, viewetag='v1', cloneetag='c1')
+        buffer={}
+        windows={}
+        unchanged=diffTraffic(buffer, windows, stored,
+                              (stats('views', {'2024-06-01': (5, 2)}), 'v1'),
+                              (stats('clones', {'2024-06-01': (3, 1)}), 'c1'))
+        self.assertEqual(unchanged, 1)
+        self.assertEqual(buffer, {})
+        self.assertEqual(windows, {})
+
+    def testBothNotModified(self):
+        stored=repo(window={'2024-06-01': [5, 2, 3, 1]}, viewetag='v1', cloneetag='c1')
+        buffer={}
+        windows={}
+        self.assertEqual(diffTraffic(buffer, windows, stored, (None, 'v1'), (None, 'c1')), 0)
+        self.assertEqual((buffer, windows), ({}, {}))
+
+    def testOneNotModifiedOtherChanged(self):
+        stored=repo(window={'2024-06-01': [5, 2, 3, 1]}, viewetag='v1', cloneetag='c1')
+        buffer={}
+        windows={}
+        diffTraffic(buffer, windows, stored, (None, 'v1'), (stats('clones', {'2024-06-01': (4, 2)}), 'c2'))
+        # the views of the stored window are kept, not reset
+        self.assertEqual(buffer, {(1000, '2024-06-01'): [5, 2, 4, 2]})
+        rid, digest, days, viewetag, cloneetag=windows[1000]
+        self.assertEqual(json.loads(days), {'2024-06-01': [5, 2, 4, 2]})
+        self.assertEqual((viewetag, cloneetag), ('v1', 'c2'))
+
+    def testNewRecordWithoutWindowSharingRepository(self):
+        # a second record of the same GitHub repository, e.g. of another
+        # tenant, gets all days even though the first one is up to date
+        first=repo(rid=1000, window={'2024-06-01': [5, 2, 3, 1]}, viewetag='v1', cloneetag='c1')
+        second=repo(rid=1001)
+        views=(stats('views', {'2024-06-01': (5, 2)}), 'v1')
+        clones=(stats('clones', {'2024-06-01': (3, 1)}), 'c1')
+        buffer={}
+        windows={}
+        diffTraffic(buffer, windows, first, views, clones)
+        diffTraffic(buffer, windows, second, views, clones)
+        self.assertEqual(buffer, {(1001, '2024-06-01'): [5, 2, 3, 1]})
+        self.assertEqual(list(windows), [1001])
+
+    def testEmptyWindow(self):
+        buffer={}
+        windows={}
+        unchanged=diffTraffic(buffer, windows, repo(), (stats('views', {}), 'v1'), (stats('clones', {}), 'c1'))
+        self.assertEqual(unchanged, 0)
+        self.assertEqual(buffer, {})
+        self.assertEqual(json.loads(windows[1000][2]), {})
+
+    def testDecreasedCountStoresWindowOnly(self):
+        stored=repo(window={'2024-06-01': [5, 2, 3, 1]})
+        buffer={}
+        windows={}
+        unchanged=diffTraffic(buffer, windows, stored,
+                              (stats('views', {'2024-06-01': (4, 2)}), None),
+                              (stats('clones', {'2024-06-01': (3, 1)}), None))
+        self.assertEqual(unchanged, 1)
+        self.assertEqual(buffer, {})
+        self.assertEqual(json.loads(windows[1000][2]), {'2024-06-01': [4, 2, 3, 1]})
+
+
+class UpdateRollupsTest(unittest.TestCase):
+
+    class Connection:
+        def __init__(self):
+            self.calls=[]
+        def execute(self, stmt, params):
+            self.calls.append(params)
+
+    def testFullWeeksAndMonths(self):
+        conn=self.Connection()
+        updateRollups([(7, '2024-06-30', 1, 1, 0, 0), (7, '2024-07-02', 1, 1, 0, 0)], conn)
+        weeks, months=conn.calls
+        self.assertEqual(weeks, [(7, datetime.date(2024, 6, 24), datetime.date(2024, 7, 7))])
+        self.assertEqual(months, [(7, datetime.date(2024, 6, 1), datetime.date(2024, 7, 31))])
+
+
+class RetentionCutoffsTest(unittest.TestCase):
+
+    def testKeepAll(self):
+        self.assertEqual(retentionCutoffs(0, 0, today=datetime.date(2024, 6, 15)), (None, None))
+
+    def testDailyCutoffIsMondayAndFirstOfMonth(self):
+        daily, weekly=retentionCutoffs(60, 30, today=datetime.date(2024, 6, 15))
+        # 2024-04-16 goes back to 2024-04-01, a Monday
+        self.assertEqual(daily, datetime.date(2024, 4, 1))
+        self.assertEqual(weekly, datetime.date(2024, 5, 16))
+        daily, weekly=retentionCutoffs(60, 0, today=datetime.date(2024, 8, 15))
+        self.assertEqual((daily.day, daily.weekday()), (1, 0))
+        self.assertLessEqual(daily, datetime.date(2024, 6, 16))
+
+
+class LttbTest(unittest.TestCase):
+
+    def testShortSeriesUnchanged(self):
+        points=[(1, 1), (2, 5), (3, 2)]
+        self.assertEqual(lttb(points, 10), points)
+
+    def testKeepsEndsAndPeak(self):
+        points=[(x, 100 if x==50 else 1) for x in range(100)]
+        sampled=lttb(points, 10)
+        self.assertEqual(len(sampled), 10)
+        self.assertEqual((sampled[0], sampled[-1]), (points[0], points[-1]))
+        self.assertIn((50, 100), sampled)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+--- Upgrade of an existing database to the schema in database.sql.
+--- New deployments use database.sql (via /admin/secondstep) instead.
+--- Run once against the database, e.g., with the Db2 command line:
+---   db2 connect to <database>
+---   db2 -tvf upgrade.sql
+--- The app should be stopped while upgrading.
+
+--- repository data: collection schedule and soft delete
+alter table repos add column lastcollected timestamp;
+alter table repos add column deleted timestamp;
+
+--- repotraffic is range partitioned in database.sql. Existing tables keep
+--- working without partitions, converting them requires moving the data
+--- (e.g., with SYSPROC.ADMIN_MOVE_TABLE) and is left to the administrator.
+
+--- last traffic window fetched per repository
+create table repowindow
+(
+  rid int unique not null,
+  digest char(40) not null,
+  days varchar(4000) not null, --- JSON object, day: [views, uniques, clones, uniques]
+  viewetag varchar(255),    --- ETags of the GitHub responses for conditional requests
+  cloneetag varchar(255)
+) organize by row;
+
+--- traffic statistics of deleted repositories
+create table repotrafficarchive
+(
+  rid int not null,
+  orgname varchar(255) not null,
+  reponame varchar(255) not null,
+  tdate date not null,
+  viewcount int not null default 0,
+  vuniques int not null default 0,
+  clonecount int not null default 0,
+  cuniques int not null default 0,
+  archived timestamp not null default current timestamp
+) organize by row;
+
+--- weekly and monthly rollups
+create table repotrafficweekly
+(
+  rid int not null,
+  weekstart date not null,
+  viewcount int not null default 0,
+  vuniques int not null default 0,
+  clonecount int not null default 0,
+  cuniques int not null default 0
+) organize by row;
+
+create unique index repotrafficweekly_ix_rid_weekstart on repotrafficweekly(rid,weekstart);
+
+create table repotrafficmonthly
+(
+  rid int not null,
+  monthstart date not null,
+  viewcount int not null default 0,
+  vuniques int not null default 0,
+  clonecount int not null default 0,
+  cuniques int not null default 0
+) organize by row;
+
+create unique index repotrafficmonthly_ix_rid_monthstart on repotrafficmonthly(rid,monthstart);
+
+--- build the rollups from the existing traffic data
+insert into repotrafficweekly
+  select rid, tdate - (dayofweek_iso(tdate)-1) days, sum(viewcount), sum(vuniques), sum(clonecount), sum(cuniques)
+  from repotraffic group by rid, tdate - (dayofweek_iso(tdate)-1) days;
+
+insert into repotrafficmonthly
+  select rid, tdate - (day(tdate)-1) days, sum(viewcount), sum(vuniques), sum(clonecount), sum(cuniques)
+  from repotraffic group by rid, tdate - (day(tdate)-1) days;
+
+--- version of the traffic and repository data
+create table dataversion
+(
+  version int not null,
+  modified timestamp not null  --- UTC
+) organize by row;
+
+insert into dataversion values(1, current timestamp - current timezone);
+
+--- collection runs and their work queue
+create table collectruns
+(
+  runid int unique not null generated by default as identity (start with 1, increment by 1),
+  started timestamp not null,
+  updated timestamp not null,
+  state varchar(20) not null --- running, completed or abandoned
+) organize by row;
+
+create table collectwork
+(
+  runid int not null,
+  tid int not null,
+  rid int not null,
+  state varchar(10) not null, --- pending, leased, done, failed or skipped
+  owner varchar(100),         --- instance holding the lease
+  leaseuntil timestamp,
+  attempts int not null default 0
+) organize by row;
+
+create unique index collectwork_ix_runid_tid_rid on collectwork(runid,tid,rid);
+create index collectwork_ix_runid_state on collectwork(runid,state);
+
+--- repositories failing to be collected
+create table repofailures
+(
+  rid int unique not null,    --- repository of the collection work entry
+  status int,                 --- last HTTP status, NULL for other errors
+  message varchar(255),
+  failures int not null,      --- consecutive failures
+  skipruns int not null,      --- runs to skip before the next try
+  firstfailed timestamp not null,
+  lastfailed timestamp not null,
+  quarantined char(1) not null default 'N'  --- Y: not collected until released
+) organize by row;
+
+--- repositories a system user has access to
+create table useraccess
+(
+  email varchar(255) not null,
+  rid int not null
+) organize by row;
+
+create unique index useraccess_ix_email_rid on useraccess(email,rid);
+
+--- initialize the access index from the role information
+insert into useraccess (email, rid) select distinct email, rid from v_adminuserrepos;